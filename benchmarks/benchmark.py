@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.append('./pipelineFiles')
+import classification
+import get_aln_regions
+from get_aln_regions import etsv
+from pipeline import REGIONS_PATH, default_regions
+
+from generate_data import generate_regions, generate_stockholm, parse_size
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+# synthetic data set of the golden check and the repository fixture with their golden class tables
+GOLDEN_HITS = 5000
+GOLDEN_SEED = 0
+FIXTURE_STK = os.path.join(os.path.dirname(REGIONS_PATH), 'file.stk')
+
+
+# function for measuring wall time of func and, with memory, peak of traced allocations in a second run
+# tracing slows allocations down, so time is taken from the untraced run
+# data frame arguments are copied for every run, returns (result, seconds, peak bytes or None)
+def measure(func, *args, memory=False):
+    def copied():
+        return [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args]
+    run_args = copied()
+    start = time.perf_counter()
+    result = func(*run_args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        run_args = copied()
+        tracemalloc.start()
+        func(*run_args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+# function for cutting all regions of all records with cut_region
+def cut_all(records, regions):
+    n_rows = 0
+    for hmmid, seqid, aln in records:
+        start, _end = get_aln_regions.parse_coords(seqid.split('/', 1)[1])
+        maps = get_aln_regions.coord_maps(aln)
+        for _region, hmm_coords in regions[hmmid]:
+            get_aln_regions.cut_region(aln, start, hmm_coords, maps)
+            n_rows += 1
+    return n_rows
+
+
+def process_all(stk, regions):
+    with open(stk) as instk, open(os.devnull, 'w') as outfile:
+        outsv = etsv.ETSVWriter(outfile, get_aln_regions.REGION_FIELDS)
+        get_aln_regions.process_alignments(instk, outsv, regions)
+
+
+def write_all(rows):
+    with open(os.devnull, 'w') as outfile:
+        outsv = etsv.ETSVWriter(outfile, get_aln_regions.REGION_FIELDS)
+        outsv.write_entries(rows)
+    return len(rows)
+
+
+def read_all(path, batch_size=None):
+    with open(path) as intsv:
+        fields = [etsv.InputField(field.name, str(field)) for field in get_aln_regions.REGION_FIELDS]
+        reader = etsv.ETSVReader(intsv, fields)
+        if batch_size:
+            return sum(len(batch['hit_id']) for batch in reader.iter_batches(batch_size))
+        return sum(1 for _vals in reader)
+
+
+# function for running every stage on generated data of n_hits hits
+# returns list of dicts with stage name, size, seconds, peak memory and rows in and out
+def run_stages(n_hits, seed=0, memory=False, workdir=None):
+    regions = default_regions()
+    stk = os.path.join(workdir, 'hits.stk')
+    region_tsv = os.path.join(workdir, 'regions.tsv')
+    with open(stk, 'w') as outstk:
+        generate_stockholm(outstk, n_hits, seed)
+    with open(region_tsv, 'w') as outtsv:
+        generate_regions(stk, outtsv)
+    with open(stk) as instk:
+        records = list(get_aln_regions.read_stockholm(instk, regions))
+        instk.seek(0)
+        rows = list(get_aln_regions.iter_region_rows(instk, regions))
+    df = pd.read_csv(region_tsv, sep='\t')
+
+    results = []
+
+    def stage(name, func, *args, rows_in):
+        result, seconds, peak = measure(func, *args, memory=memory)
+        if isinstance(result, tuple):
+            # sequence_filtration also returns proteins with several catalytic domains
+            rows_out = len(result[0])
+        else:
+            rows_out = result if isinstance(result, int) else len(result) if result is not None else None
+        results.append(dict(stage=name, hits=n_hits, seconds=round(seconds, 4),
+                            peak_mb=None if peak is None else round(peak / 2**20, 1),
+                            rows_in=rows_in, rows_out=rows_out))
+        return result
+
+    stage('cut_region', cut_all, records, regions, rows_in=len(records))
+    stage('process_alignments', process_all, stk, regions, rows_in=len(records))
+    stage('ETSVWriter', write_all, rows, rows_in=len(rows))
+    stage('ETSVReader', read_all, region_tsv, rows_in=len(rows))
+    stage('ETSVReader.iter_batches', read_all, region_tsv, 10000, rows_in=len(rows))
+    filtered = stage('region_filtration', classification.region_filtration, df, rows_in=len(df))
+    kept, _several = stage('sequence_filtration', classification.sequence_filtration, filtered,
+                           rows_in=len(filtered))
+    region_sets = stage('set_of_regions', classification.set_of_regions, kept, rows_in=len(kept))
+    best = stage('best_profile', classification.best_profile, region_sets, rows_in=len(region_sets))
+    stage('assign_class', classification.assign_class, best, rows_in=len(best))
+    return results
+
+
+# function for making class table of Stockholm alignments as pipline steps 2 and 3 do
+def class_table(stk):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        region_tsv = os.path.join(tmpdir, 'regions.tsv')
+        with open(region_tsv, 'w') as outtsv:
+            generate_regions(stk, outtsv)
+        df, _several = classification.classify(classification.read_region_table(region_tsv))
+    output = io.StringIO()
+    df.to_csv(output, sep='\t')
+    return output.getvalue()
+
+
+# function for comparing class tables of the fixture and the synthetic golden set with golden files
+# with update the golden files are written instead, returns names of differing tables
+def check_golden(update=False):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stk = os.path.join(tmpdir, 'golden.stk')
+        with open(stk, 'w') as outstk:
+            generate_stockholm(outstk, GOLDEN_HITS, GOLDEN_SEED)
+        tables = {'file_class.tsv': class_table(FIXTURE_STK), 'synthetic_class.tsv': class_table(stk)}
+    failed = []
+    for name, table in tables.items():
+        path = os.path.join(GOLDEN_DIR, name)
+        if update:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            with open(path, 'w') as outfile:
+                outfile.write(table)
+            continue
+        with open(path) as infile:
+            if infile.read() != table:
+                failed.append(name)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time pipeline stages on synthetic data and check class tables against golden outputs.')
+    parser.add_argument('--sizes', default='1k,10k', metavar='N[,N...]',
+                        help='numbers of hits of generated data sets, e.g. 1k,100k,10M, default is %(default)s')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true',
+                        help='also measure peak memory with tracemalloc, stages run slower')
+    parser.add_argument('--json', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--check', action='store_true',
+                        help='only compare class tables with golden outputs (byte-identical)')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='write golden outputs of the current code')
+    args = parser.parse_args()
+    if args.check or args.update_golden:
+        failed = check_golden(args.update_golden)
+        if failed:
+            sys.exit('class tables differ from golden outputs: ' + ', '.join(failed))
+        print('golden outputs written' if args.update_golden else 'class tables match golden outputs')
+        return
+    results = []
+    for size in args.sizes.split(','):
+        with tempfile.TemporaryDirectory() as workdir:
+            results += run_stages(parse_size(size), args.seed, args.memory, workdir)
+    print(pd.DataFrame(results, dtype=object).to_string(index=False))
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=1)
+
+if __name__ == '__main__':
+    main()
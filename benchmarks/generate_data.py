@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+
+import numpy as np
+
+sys.path.append('./pipelineFiles')
+import get_aln_regions
+from pipeline import PROFILES_PATH, REGIONS_PATH
+
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+# hmmsearch writes alignments of at most this many hits per block in generated files
+BLOCK_HITS = 1000
+# probabilities of deleted match state and of insert after match state
+DELETE_RATE = 0.05
+INSERT_RATE = 0.01
+# share of hits covering only a part of the profile
+PARTIAL_RATE = 0.2
+# share of hits of MTases with rare architectures: circularly permuted MTases of class F,
+# hit by a profile in two parts with the Hd1 part first, and MTases of class E with a short
+# loop before S7-S4, made by deleting profile states between Hd2-Hd3 and S7-S4
+VARIANT_RATE = 0.01
+PERMUTED_PROFILE = '0046303'
+SHORT_LOOP_PROFILE = '0048856'
+
+
+# function for reading profile names, lengths and match and insert emission probabilities from HMMER3 file
+def read_profiles(path=PROFILES_PATH):
+    profiles = []
+    with open(path) as infile:
+        lines = iter(infile)
+        for line in lines:
+            if line.startswith('NAME '):
+                name = line.split()[1]
+            elif line.startswith('HMM '):
+                # transition header and optional COMPO lines come before the first node
+                next(lines)
+                match, insert = [], []
+                for line in lines:
+                    fields = line.split()
+                    if fields[0] == '//':
+                        break
+                    if fields[0].isdigit():
+                        match.append([float(x) for x in fields[1:21]])
+                        insert.append([float(x) for x in next(lines).split()[:20]])
+                profiles.append((name, np.exp(-np.array(match)), np.exp(-np.array(insert))))
+    return profiles
+
+
+# function for sampling residues of every column from per-column emission probabilities
+def sample_residues(rng, probs, n_rows):
+    cum = np.cumsum(probs / probs.sum(axis=1, keepdims=True), axis=1)
+    u = rng.random((n_rows, len(probs)))
+    idx = (u[:, :, None] > cum[None, :, :-1]).sum(axis=2)
+    return AMINO_ACIDS[idx]
+
+
+# function for making one Stockholm block of hits of one profile
+# hits are given by protein numbers and protein start coordinates, returns block text
+# covered HMM coordinates are random unless given as spans, deleted are (from, to) HMM coordinates
+# of states deleted in every hit
+def make_block(rng, profile, proteins, starts, spans=None, deleted=None):
+    name, match, insert = profile
+    n_rows, length = len(proteins), len(match)
+    # HMM coordinates covered by every hit
+    if spans is None:
+        partial = rng.random(n_rows) < PARTIAL_RATE
+        span = np.where(partial, rng.uniform(0.3, 1.0, n_rows), rng.uniform(0.9, 1.0, n_rows))
+        cover = np.maximum(1, (span * length).astype(int))
+        hmm_from = 1 + (rng.random(n_rows) * (length - cover + 1)).astype(int)
+        hmm_to = hmm_from + cover - 1
+    else:
+        hmm_from, hmm_to = (np.asarray(x) for x in zip(*spans))
+    nodes = np.arange(1, length + 1)
+    covered = (nodes >= hmm_from[:, None]) & (nodes <= hmm_to[:, None])
+    residues = sample_residues(rng, match, n_rows)
+    present = covered & (rng.random((n_rows, length)) >= DELETE_RATE)
+    if deleted is not None:
+        present &= ~((nodes >= deleted[0]) & (nodes <= deleted[1]))
+    match_chars = np.where(present, residues, ord('-'))
+    # inserts after match states, not after the last covered state
+    inserts = np.where(covered & (nodes < hmm_to[:, None]) & (rng.random((n_rows, length)) < INSERT_RATE),
+                       rng.integers(1, 6, (n_rows, length)), 0)
+    width = inserts.max(axis=0)
+    # alignment column of every match state
+    match_cols = np.arange(length) + np.concatenate(([0], np.cumsum(width)[:-1]))
+    chars = np.full((n_rows, length + width.sum()), ord('.'), dtype=np.uint8)
+    chars[:, match_cols] = match_chars
+    rows, node_idx = np.nonzero(inserts)
+    lens = inserts[rows, node_idx]
+    ins_starts = np.repeat(match_cols[node_idx] + 1, lens)
+    steps = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    # inserted residues are lowercase, drawn from insert emissions of the first state
+    background = insert[0] / insert[0].sum()
+    chars[np.repeat(rows, lens), ins_starts + steps] = rng.choice(AMINO_ACIDS, lens.sum(), p=background) + 32
+    # protein coordinates of the aligned part
+    n_res = present.sum(axis=1) + inserts.sum(axis=1)
+    lines = ['# STOCKHOLM 1.0\n', f'#=GF ID {name}\n', '\n']
+    for protein, start, row, n in zip(proteins, starts, chars, n_res):
+        lines.append(f'P{protein:08d}/{start}-{start + max(n, 1) - 1} {row.tobytes().decode()}\n')
+    rf = np.full(chars.shape[1], ord('.'), dtype=np.uint8)
+    rf[match_cols] = ord('x')
+    lines.append(f'#=GC RF {rf.tobytes().decode()}\n')
+    lines.append('//\n')
+    return ''.join(lines)
+
+
+# function for writing Stockholm alignments of n_hits synthetic hits of the profiles
+# proteins are hit by one to three profiles, as real MTases hit by profiles of the same family
+def generate_stockholm(outstk, n_hits, seed=0, profiles=None):
+    rng = np.random.default_rng(seed)
+    profiles = profiles or read_profiles()
+    # two hits of every permuted MTase and one of every MTase with short loop
+    n_variants = int(n_hits * VARIANT_RATE)
+    n_hits -= 3 * n_variants
+    # number of hits of every protein
+    counts = rng.choice([1, 2, 3], n_hits, p=[0.5, 0.35, 0.15])
+    n_proteins = np.searchsorted(np.cumsum(counts), n_hits) + 1
+    counts = counts[:n_proteins]
+    counts[-1] -= counts.sum() - n_hits
+    proteins = np.repeat(np.arange(1, n_proteins + 1), counts)
+    # hit number inside its protein
+    ranks = np.arange(n_hits) - np.repeat(np.cumsum(counts) - counts, counts)
+    # different profiles for hits of one protein: first profiles of a random permutation
+    hit_profiles = np.empty(n_hits, dtype=np.intp)
+    for first in range(0, n_proteins, 10**6):
+        perms = np.argsort(rng.random((min(10**6, n_proteins - first), len(profiles))), axis=1)
+        in_chunk = (proteins > first) & (proteins <= first + len(perms))
+        hit_profiles[in_chunk] = perms[proteins[in_chunk] - first - 1, ranks[in_chunk]]
+    starts = rng.integers(1, 200, n_hits)
+    for i, profile in enumerate(profiles):
+        hits = np.nonzero(hit_profiles == i)[0]
+        for first in range(0, len(hits), BLOCK_HITS):
+            block = hits[first:first + BLOCK_HITS]
+            outstk.write(make_block(rng, profile, proteins[block], starts[block]))
+    if n_variants:
+        write_variants(outstk, rng, profiles, n_variants, proteins[-1] + 1 if n_hits else 1)
+
+
+# function for writing hits of n_variants permuted MTases and n_variants MTases with short loop
+# proteins are numbered from first_protein
+def write_variants(outstk, rng, profiles, n_variants, first_protein):
+    regions = {hmmid: dict((name, coords[0]) for name, coords in hmm_regions)
+               for hmmid, hmm_regions in get_aln_regions.read_regions(REGIONS_PATH).items()}
+    by_name = {profile[0]: profile for profile in profiles}
+    permuted = by_name[PERMUTED_PROFILE]
+    length = len(permuted[1])
+    split = regions[PERMUTED_PROFILE]['Hd1'][0]
+    proteins = np.arange(first_protein, first_protein + n_variants)
+    starts = rng.integers(1, 200, n_variants)
+    # the Hd1 part lies before the rest of the domain in the protein
+    outstk.write(make_block(rng, permuted, np.concatenate([proteins, proteins]),
+                            np.concatenate([starts, starts + 10 * length]),
+                            spans=[(split, length)] * n_variants + [(1, split - 1)] * n_variants))
+    short_loop = by_name[SHORT_LOOP_PROFILE]
+    deleted = (regions[SHORT_LOOP_PROFILE]['Hd2-Hd3'][1] + 5, regions[SHORT_LOOP_PROFILE]['S7-S4'][0] - 5)
+    outstk.write(make_block(rng, short_loop, proteins + n_variants, rng.integers(1, 200, n_variants),
+                            spans=[(1, len(short_loop[1]))] * n_variants, deleted=deleted))
+
+
+# function for writing region table of Stockholm alignments, as pipline step 2 does
+def generate_regions(instk_path, outtsv, regions_path=REGIONS_PATH):
+    regions = get_aln_regions.read_regions(regions_path)
+    with open(instk_path) as instk:
+        outsv = get_aln_regions.etsv.ETSVWriter(outtsv, get_aln_regions.REGION_FIELDS)
+        get_aln_regions.process_alignments(instk, outsv, regions)
+
+
+# function for parsing sizes like 1000, 10k or 10M
+def parse_size(size):
+    units = {'k': 10**3, 'K': 10**3, 'M': 10**6}
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic hmmsearch alignments and region table from the MTase profiles.')
+    parser.add_argument('hits', type=parse_size, help='number of hits, e.g. 1000, 100k or 10M')
+    parser.add_argument('stockholm', metavar='output.stk')
+    parser.add_argument('--regions-output', metavar='regions.tsv',
+                        help='also write region table of the generated alignments')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    with open(args.stockholm, 'w') as outstk:
+        generate_stockholm(outstk, args.hits, args.seed)
+    if args.regions_output:
+        with open(args.regions_output, 'w') as outtsv:
+            generate_regions(args.stockholm, outtsv)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
 from .main import Field, InputField, OutputField, ETSVReader, ETSVWriter
+from .main import open_file
+from .main import build_key_index, find_key_offsets, key_index_path
 from .args import (ETSVType, SetETSVParameter, StoreETSVType,
                    add_etsv_options, add_field_options)
 
 __all__ = [
     Field, InputField, OutputField,
     ETSVReader, ETSVWriter,
+    open_file,
+    build_key_index, find_key_offsets, key_index_path,
     ETSVType,
     SetETSVParameter, StoreETSVType,
     add_etsv_options, add_field_options,
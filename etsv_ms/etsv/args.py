@@ -5,7 +5,7 @@ import argparse
 import sys
 from contextlib import suppress
 
-from .main import ETSVReader, ETSVWriter
+from .main import ETSVReader, ETSVWriter, open_file
 
 
 class ETSVType:
@@ -23,7 +23,7 @@ class ETSVType:
         if value == "-":
             fileobj = sys.stdin if self._mode == "r" else sys.stdout
         else:
-            fileobj = open(value, self._mode)
+            fileobj = open_file(value, self._mode)
         self._fileobj = fileobj
         return self
 
@@ -9,12 +9,18 @@ all other lines are ordinary TSV (TAB-separated values) data.
 The module contains wrappers for file objects which allows to read
 specified fields from a TSV line into a dict, and to write values from
 a dict to a file. `InputField` and `OutputField` objects describe column
-positions, names and value formats.
+positions, names and value formats. Rows can also be read and written
+in bulk, as tuples or as columns.
 """
 
 
+import gzip
+import io
+import os
 from contextlib import suppress
-from typing import Callable, Dict, Iterable
+from itertools import islice
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 from typing import Any, Optional, Union
 
 
@@ -73,6 +79,13 @@ class InputField(Field):
         """Find the value, transform and return it as a (key, value) pair."""
         return self.name, self._value_type(values[self.index])
 
+    def parse_column(self, rows) -> List[Any]:
+        """Take the values of the column from split lines and transform them."""
+        column = list(map(itemgetter(self.index), rows))
+        if self._value_type is not str:
+            column = list(map(self._value_type, column))
+        return column
+
 
 class OutputField(Field): # pylint: disable=too-few-public-methods
     """Output TSV field.
@@ -93,6 +106,10 @@ class OutputField(Field): # pylint: disable=too-few-public-methods
         """"""#TODO
         return self._value_format(values[self.name])
 
+    def format_column(self, column) -> List[str]:
+        """Format all values of a column."""
+        return list(map(self._value_format, column))
+
 
 class _OneStepBackIterator:
     """Iterator wrapper that allows to take one step back."""
@@ -102,6 +119,9 @@ class _OneStepBackIterator:
         self._stepped_back = False
         self._last = None
 
+    def __iter__(self):
+        return self
+
     def __next__(self):
         if self._stepped_back:
             self._stepped_back = False
@@ -109,6 +129,19 @@ class _OneStepBackIterator:
             self._last = next(self._iterator)
         return self._last
 
+    def take(self, size):
+        """Return a list of up to `size` next items (all if None)."""
+        items = []
+        if self._stepped_back:
+            self._stepped_back = False
+            items.append(self._last)
+            if size is not None:
+                size -= 1
+        items.extend(islice(self._iterator, size))
+        if items:
+            self._last = items[-1]
+        return items
+
     def step_back(self):
         """"""#TODO
         if self._stepped_back:
@@ -126,6 +159,7 @@ class ETSVReader:
         self._params["force_title"] = kwargs.pop("force_title", False)
         self._params["extended_tsv"] = kwargs.pop("extended_tsv", True)
         self._params["maxsplit"] = kwargs.pop("maxsplit", -1)
+        self._params["key_column"] = kwargs.pop("key_column", None)
         if kwargs:
             args = ", ".join(kwargs)
             end = "" if len(kwargs) == 1 else "s"
@@ -134,6 +168,8 @@ class ETSVReader:
             if field.index is None:
                 self._params["force_title"] = True
                 break
+        if isinstance(self._params["key_column"], str):
+            self._params["force_title"] = True
         self._fileobj = fileobj
         self._fields = fields
         self._iterator = None
@@ -154,6 +190,7 @@ class ETSVReader:
             self._iterator.step_back()
         if not self.title and self._params["force_title"]:
             self.title = self._split_line(next(self._iterator))
+            self._params["title_in_data"] = True
         for field in self._fields:
             if field.index is None:
                 field.take_index(self.title or [])
@@ -176,6 +213,234 @@ class ETSVReader:
         """Read a next line and parse it."""
         return next(self, None)
 
+    def _read_lines(self, size: Optional[int]) -> List[str]:
+        # read up to `size` next lines (all if None)
+        if self._iterator is None:
+            return []
+        return self._iterator.take(size)
+
+    def _split_lines(self, lines) -> List[List[str]]:
+        if self._params["extended_tsv"]:
+            lines = [line for line in lines if not line.startswith("#")]
+        maxsplit = self._params["maxsplit"]
+        return [line.strip("\n").split("\t", maxsplit) for line in lines]
+
+    def _columns(self, rows, arrays: bool) -> Dict[str, Any]:
+        columns = {field.name: field.parse_column(rows) for field in self._fields}
+        if arrays:
+            import numpy # pylint: disable=import-outside-toplevel
+            # text columns become object arrays, fixed-width unicode
+            # arrays would be slow to build and as wide as the longest value
+            columns = {name: numpy.asarray(column, dtype=object)
+                         if column and isinstance(column[0], str)
+                         else numpy.asarray(column)
+                       for name, column in columns.items()}
+        return columns
+
+    def iter_batches(self, size: int,
+                     arrays: bool = False) -> Iterator[Dict[str, Any]]:
+        """Read the rest of the file in batches of about `size` lines.
+
+        Every batch is a dict of field names and lists of parsed values
+        (NumPy arrays with `arrays`). Values are parsed column by column,
+        which is much faster than reading entries one by one.
+        """
+        while True:
+            lines = self._read_lines(size)
+            if not lines:
+                break
+            rows = self._split_lines(lines)
+            if rows:
+                yield self._columns(rows, arrays)
+
+    def read_columns(self, arrays: bool = False) -> Dict[str, Any]:
+        """Read the rest of the file into a dict of columns."""
+        return self._columns(self._split_lines(self._read_lines(None)), arrays)
+
+    def lookup(self, key: str) -> List[Dict[str, Any]]:
+        """Return entries of all lines with `key` in the key column.
+
+        The key column is given by the `key_column` keyword argument
+        (header or 0-based index). Lines are found through a sidecar
+        index next to the file, built on the first lookup and rebuilt
+        when the file changes. Only plain (uncompressed) files on disk
+        can be looked up, ValueError is raised for compressed files and
+        streams. Lookups do not move the position of iteration.
+        """
+        key_column = self._params["key_column"]
+        if key_column is None:
+            raise TypeError("lookup requires the key_column argument")
+        if isinstance(key_column, str):
+            if key_column not in (self.title or []):
+                raise ValueError(f"can't find the column named '{key_column}'")
+            key_index = self.title.index(key_column)
+        else:
+            key_index = key_column
+        path = _plain_file_path(self._fileobj)
+        offsets = find_key_offsets(
+            path, key_index, key, extended_tsv=self._params["extended_tsv"],
+            skip_title=self._params.get("title_in_data", False))
+        entries = []
+        with open(path, "rb") as infile:
+            for offset in offsets:
+                infile.seek(offset)
+                vals = self._split_line(infile.readline().decode())
+                entries.append(dict(field.parse_value(vals)
+                                    for field in self._fields))
+        return entries
+
+    def iter_tuples(self, batch_size: int = 10000) -> Iterator[Tuple[Any, ...]]:
+        """Read the rest of the file as tuples of values in field order.
+
+        Tuples are lighter than the dicts returned by iteration.
+        """
+        for batch in self.iter_batches(batch_size):
+            yield from zip(*batch.values())
+
+
+def _plain_file_path(fileobj) -> str:
+    """Return the path of a file object reading a plain file from disk.
+
+    Lines are found by byte offsets in the file, so compressed files
+    (`gzip.open`, `open_file` on `.gz` or `.zst`) and streams without a
+    file (stdin, pipes, in-memory buffers) can't be looked up.
+    """
+    raw = getattr(fileobj, "buffer", fileobj)
+    raw = getattr(raw, "raw", raw)
+    if not isinstance(raw, io.FileIO):
+        raise ValueError("lookup requires an uncompressed file opened "
+                         "from disk, not a compressed or in-memory stream")
+    if not isinstance(raw.name, str) or not os.path.isfile(raw.name):
+        raise ValueError("lookup requires a regular file, "
+                         "not stdin or a pipe")
+    return raw.name
+
+
+def open_file(path: str, mode: str = "r", compression: Optional[str] = None):
+    """Open a text file, plain or compressed with gzip or zstd.
+
+    Without `compression` it is chosen by the file name suffix
+    (`.gz` or `.zst`). zstd requires the `zstandard` package.
+    """
+    if compression is None:
+        if path.endswith(".gz"):
+            compression = "gzip"
+        elif path.endswith(".zst"):
+            compression = "zstd"
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        return gzip.open(path, mode + "t")
+    if compression == "zstd":
+        try:
+            import zstandard # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise ImportError("zstd files require the zstandard package") from error
+        return zstandard.open(path, mode + "t")
+    raise ValueError(f"unknown compression '{compression}'")
+
+
+_KEY_INDEX_TITLE = "#:etsvindex"
+
+
+def key_index_path(path: str, key_index: int) -> str:
+    """Return the path of the sidecar key index of a file."""
+    return f"{path}.key{key_index}.idx"
+
+
+def _file_stamp(path: str) -> str:
+    stat = os.stat(path)
+    return f"{_KEY_INDEX_TITLE}\t{stat.st_size}\t{stat.st_mtime_ns}\n"
+
+
+def build_key_index(path: str, key_index: int, extended_tsv: bool = True,
+                    skip_title: bool = False) -> None:
+    """Write the sidecar index of byte offsets of lines by their key.
+
+    The index starts with a stamp of the indexed file, followed by
+    `key TAB offset[,offset...]` lines sorted by key bytes, so a key is
+    found by binary search without reading the whole index.
+    """
+    entries = []
+    offset = 0
+    with open(path, "rb") as infile:
+        for line in infile:
+            if not (extended_tsv and line.startswith(b"#")):
+                if skip_title:
+                    skip_title = False
+                else:
+                    values = line.rstrip(b"\r\n").split(b"\t")
+                    if key_index < len(values):
+                        entries.append((values[key_index], offset))
+            offset += len(line)
+    # sorting is stable, offsets of one key stay in file order
+    entries.sort(key=itemgetter(0))
+    tmp_path = key_index_path(path, key_index) + ".tmp"
+    with open(tmp_path, "wb") as outfile:
+        outfile.write(_file_stamp(path).encode())
+        i = 0
+        while i < len(entries):
+            key = entries[i][0]
+            offsets = []
+            while i < len(entries) and entries[i][0] == key:
+                offsets.append(b"%d" % entries[i][1])
+                i += 1
+            outfile.write(key + b"\t" + b",".join(offsets) + b"\n")
+    os.replace(tmp_path, key_index_path(path, key_index))
+
+
+def _search_key_index(inidx, start: int, key: bytes) -> List[int]:
+    # binary search of the first line with `key` in the sorted index
+    inidx.seek(0, os.SEEK_END)
+    low, high = start, inidx.tell()
+    while low < high:
+        middle = (low + high) // 2
+        inidx.seek(middle)
+        if middle > start:
+            # move to the beginning of the next line
+            inidx.readline()
+        line = inidx.readline()
+        if line and line.split(b"\t", 1)[0] < key:
+            low = middle + 1
+        else:
+            high = middle
+    inidx.seek(low)
+    if low > start:
+        inidx.readline()
+    for line in inidx:
+        line_key, offsets = line.rstrip(b"\n").split(b"\t", 1)
+        if line_key == key:
+            return [int(offset) for offset in offsets.split(b",")]
+        if line_key > key:
+            break
+    return []
+
+
+def find_key_offsets(path: str, key_index: int, key: str,
+                     **kwargs: Any) -> List[int]:
+    """Return byte offsets of lines of a plain file with the key.
+
+    The sidecar index is built if it is missing or stale, `kwargs` are
+    passed to `build_key_index`.
+    """
+    idx_path = key_index_path(path, key_index)
+    for _attempt in range(2):
+        with suppress(FileNotFoundError), open(idx_path, "rb") as inidx:
+            if inidx.readline().decode() == _file_stamp(path):
+                return _search_key_index(inidx, inidx.tell(), key.encode())
+        build_key_index(path, key_index, **kwargs)
+    raise RuntimeError(f"can't use key index {idx_path}")
+
+
+def _batches(iterable, size):
+    # split iterable into lists of `size` items
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
 
 class ETSVWriter: # pylint: disable=too-few-public-methods
     """ETSV writer class."""
@@ -203,3 +468,32 @@ class ETSVWriter: # pylint: disable=too-few-public-methods
         """Write TSV values to the file as a line."""
         print(*(field.format_value(vals) for field in self._fields),
               sep="\t", file=self._fileobj)
+
+    def _write_column_lists(self, columns) -> None:
+        # format columns given in field order and write them in one call
+        formatted = [field.format_column(column)
+                     for field, column in zip(self._fields, columns)]
+        lines = ["\t".join(values) for values in zip(*formatted)]
+        if lines:
+            lines.append("")
+            self._fileobj.write("\n".join(lines))
+
+    def write_entries(self, rows: Iterable[Tuple[Any, ...]],
+                      batch_size: int = 10000) -> None:
+        """Write rows given as tuples of values in field order.
+
+        Rows are formatted column by column in batches of `batch_size`
+        and every batch is written to the file at once.
+        """
+        for batch in _batches(rows, batch_size):
+            self._write_column_lists(zip(*batch))
+
+    def write_columns(self, columns: Dict[str, Any],
+                      batch_size: int = 10000) -> None:
+        """Write columns given as a dict of field names and sequences
+        of values, as returned by `ETSVReader.read_columns`."""
+        columns = [columns[field.name] for field in self._fields]
+        n_rows = len(columns[0]) if columns else 0
+        for start in range(0, n_rows, batch_size):
+            self._write_column_lists(
+                column[start:start+batch_size] for column in columns)
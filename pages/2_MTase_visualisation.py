@@ -1,39 +1,116 @@
 ### Step 1) Imports
-import stmol
+import os
+import sys
 import streamlit as st
 import py3Dmol
 from stmol import showmol
+import numpy as np
 import pandas as pd
-
-
-#color MTase chain in red
-def color_MTase(df):
-    MTasechain = {'chain':hl_chain}
-    view.setStyle(MTasechain,{'cartoon':{'color':'yellow'}})
-    #view.addResLabels({"chain": hl_chain,"resi": 1-10})
-
-    a = tuple(df[df['REBASE_name'] == option].iloc[0]['Region_coords'].split(','))
-    b = tuple(df[df['REBASE_name'] == option].iloc[0]['Regions'].split(','))
+sys.path.append('./pipelineFiles')
+import structures
+
+TABLE_PATH = './class_withStructure.tsv'
+# MTase names shown on one page of the browser
+PAGE_SIZE = 100
+
+
+# function for loading class table once per file, the separator is taken from the header line
+# as the C parser is much faster than sniffing; key identifies the file, source is read only on the first call
+# returns table, unique MTase names and row of the first entry of every name
+@st.cache_resource(max_entries=4)
+def load_class_table(key, _source):
+    header = _source.readline()
+    _source.seek(0)
+    df = pd.read_csv(_source, sep='\t' if b'\t' in header else ',')
+    names = df['REBASE_name'].astype(str)
+    first = ~names.duplicated()
+    rows = dict(zip(names[first], np.flatnonzero(first.to_numpy())))
+    return df, names[first].reset_index(drop=True), rows
+
+
+# function for finding positions of names containing the query, case insensitive
+@st.cache_resource(max_entries=32)
+def search_names(key, query, _names):
+    if not query:
+        return np.arange(len(_names))
+    return np.flatnonzero(_names.str.contains(query, case=False, regex=False).to_numpy())
+
+
+# function for choosing MTase by type-ahead search over names and pages of matches
+# returns the chosen name or None
+def choose_mtase(key, names, default=None):
+    query = st.text_input('Search MTase by name', placeholder='e.g. M.HhaI')
+    matches = search_names(key, query.strip(), names)
+    pages = max(1, -(-len(matches) // PAGE_SIZE))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f'Page of {pages} ({len(matches)} MTases found)',
+                               min_value=1, max_value=pages, value=1)
+    page_names = names.iloc[matches[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]].tolist()
+    if not page_names:
+        st.error("No MTase names match the search")
+    return st.selectbox('What MTase would you like to analyse?', page_names,
+                        index=page_names.index(default) if default in page_names else None)
+
+
+# function for parsing residue numbers and ranges like '45, 80-82'
+def parse_residues(text):
+    residues = []
+    for part in text.replace(' ', '').split(','):
+        if part:
+            start, _, end = part.partition('-')
+            residues.extend(range(int(start), int(end or start) + 1))
+    return residues
+
+
+def residue_input():
+    try:
+        return parse_residues(st.sidebar.text_input(label="Highlight Residues", placeholder="e.g. 45, 80-82"))
+    except ValueError:
+        st.sidebar.error("Residues should be numbers or ranges separated by commas")
+        return []
+
+
+# function for colour ranges of MTase regions on the chain, computed once per MTase and chain
+# later regions override overlapping residues of earlier ones, loops after detected elements are green
+# returns list of (selection, style) pairs, one for the chain and one for every colour
+@st.cache_data
+def mtase_styles(option, hl_chain, regions, region_coords):
+    colors = dict()
     i1 = 0
-
     l1 = ''
-    if hl_chain:
-        for i,l in zip(a,b):
-            if i1 != 0 and i1+1 < int(i.split('-')[0]) and l1 != 'sam_motif' and l1 != 'cat_motif':
+    for i, l in zip(region_coords.split(','), regions.split(',')):
+        start, end = (int(x) for x in i.split('-'))
+        if i1 != 0 and i1+1 < start and l1 != 'sam_motif' and l1 != 'cat_motif':
+            for k in range(i1+1, start):
+                colors[k] = 'green'
+        color = 'blue' if l == 'sam_motif' or l == 'cat_motif' else 'red'
+        for k in range(start, end + 1):
+            colors[k] = color
+        i1 = end
+        l1 = l
+    # contiguous residues of one colour as 'start-end' ranges
+    ranges = dict()
+    for k in sorted(colors):
+        color_ranges = ranges.setdefault(colors[k], [])
+        if color_ranges and color_ranges[-1][1] == k - 1:
+            color_ranges[-1][1] = k
+        else:
+            color_ranges.append([k, k])
+    styles = [({'chain': hl_chain}, {'cartoon': {'color': 'yellow'}})]
+    for color, color_ranges in ranges.items():
+        styles.append(({'chain': hl_chain, 'resi': [f'{a}-{b}' for a, b in color_ranges]},
+                       {'cartoon': {'color': color}}))
+    return styles
 
-                for k in range(i1+1, int(i.split('-')[0])):
-                    view.setStyle({'resi': k, 'chain': hl_chain}, {'cartoon': {'color': 'green'}})
 
-            if l == 'sam_motif' or l == 'cat_motif':
-
-                for k in range(int(i.split('-')[0]), int(i.split('-')[1]) + 1):
-                    view.setStyle({'resi': k, 'chain': hl_chain}, {'cartoon': {'color': 'blue'}})
-            else:
-                for k in range(int(i.split('-')[0]), int(i.split('-')[1]) + 1):
-                    view.setStyle({'resi': k, 'chain': hl_chain}, {'cartoon': {'color': 'red'}})
-            i1 = int(i.split('-')[1])
-            l1 =  l
+#color MTase chain in red
+def color_MTase(row):
+    if hl_chain:
+        for selection, style in mtase_styles(option, hl_chain, row['Regions'], row['Region_coords']):
+            view.setStyle(selection, style)
     else:
+            view.setStyle({'chain': hl_chain},{'cartoon':{'color':'yellow'}})
             st.error("Please paste chain")
 
 
@@ -50,26 +127,24 @@ option = 'M.HhaI'
 k = 1
 if uploaded_file is not None:
     k = 0
-    df = pd.read_csv(uploaded_file, sep = None)
-    option = st.selectbox(
-    'What MTase would you like to analyse?',
-    df['REBASE_name'],
-    index=None)
+    df, names, rows = load_class_table(uploaded_file.file_id, uploaded_file)
+    option = choose_mtase(uploaded_file.file_id, names)
     if not option:
         st.error("Please choose MTase")
     else:
+        row = df.iloc[rows[option]]
         st.write('You selected:', option)
-        st.write(df[df['REBASE_name'] == option][['REBASE_name', 'New_class', 'Regions', 'Region_coords']])
+        st.write(df.iloc[[rows[option]]][['REBASE_name', 'New_class', 'Regions', 'Region_coords']])
     pdb_code = st.sidebar.text_input(
         label="PDB Code")
     if not pdb_code and uploaded_file_pdb is None:
         st.sidebar.error("Please paste PDB code or paste PDB file")
-    else:
+    elif option:
         k=1
 
         hl_chain = st.sidebar.text_input(label="Choose MTase chain")
 
-        hl_resi_list = st.sidebar.multiselect(label="Highlight Residues", options=list(range(1, 5000)))
+        hl_resi_list = residue_input()
 
         label_resi = st.sidebar.checkbox(label="Label Residues", value=True)
 
@@ -82,35 +157,39 @@ if uploaded_file is not None:
 
 
         st.markdown(
-            f"## MTase {option} from class {df[df['REBASE_name'] == option].iloc[0]['New_class']}: PDB [{pdb_code.upper()}](https://www.rcsb.org/structure/{pdb_code}) (Chain {hl_chain})")
+            f"## MTase {option} from class {row['New_class']}: PDB [{pdb_code.upper()}](https://www.rcsb.org/structure/{pdb_code}) (Chain {hl_chain})")
 else:
-    df = pd.read_csv('./class_withStructure.tsv', sep=None)
+    table_key = (TABLE_PATH, os.stat(TABLE_PATH).st_mtime_ns)
+    with open(TABLE_PATH, 'rb') as infile:
+        df, names, rows = load_class_table(table_key, infile)
     st.write('## Prokaryotic MTases with available 3D structure')
-    option = st.selectbox(
-        'What MTase would you like to analyse?',
-        df['REBASE_name'],
-        index= 1)
-    st.write(df[df['REBASE_name'] == option][['REBASE_name', 'New_class', 'Repr. PDB code', 'Regions', 'Region_coords']].style.format({"Expense": lambda x : '{:.4f}'.format(x)}))
-    pdb_code = st.sidebar.text_input(
-        label="PDB Code",
-        value= df[df['REBASE_name'] == option].iloc[0]['Repr. PDB code'])
+    option = choose_mtase(table_key, names, default=names.iloc[1])
+    if not option:
+        k = 0
+        st.error("Please choose MTase")
+    else:
+        row = df.iloc[rows[option]]
+        st.write(df.iloc[[rows[option]]][['REBASE_name', 'New_class', 'Repr. PDB code', 'Regions', 'Region_coords']].style.format({"Expense": lambda x : '{:.4f}'.format(x)}))
+        pdb_code = st.sidebar.text_input(
+            label="PDB Code",
+            value= row['Repr. PDB code'])
 
-    hl_chain = st.sidebar.text_input(label="Choose MTase chain", value="A")
+        hl_chain = st.sidebar.text_input(label="Choose MTase chain", value="A")
 
-    hl_resi_list = st.sidebar.multiselect(label="Highlight Residues", options=list(range(1, 5000)))
+        hl_resi_list = residue_input()
 
-    label_resi = st.sidebar.checkbox(label="Label Residues", value=True)
+        label_resi = st.sidebar.checkbox(label="Label Residues", value=True)
 
-    surf_transp = st.sidebar.slider("Surface Transparency", min_value=0.0, max_value=1.0, value=0.0)
+        surf_transp = st.sidebar.slider("Surface Transparency", min_value=0.0, max_value=1.0, value=0.0)
 
-    hl_color = st.sidebar.text_input(label="Highlight Color",value="red")
+        hl_color = st.sidebar.text_input(label="Highlight Color",value="red")
 
-    bb_color = st.sidebar.text_input(label="Backbone Color",value="lightgrey")
-    lig_color = st.sidebar.text_input(label="Ligand Color",value="white")
+        bb_color = st.sidebar.text_input(label="Backbone Color",value="lightgrey")
+        lig_color = st.sidebar.text_input(label="Ligand Color",value="white")
 
 
-    st.markdown(
-        f"## MTase {option} from class {df[df['REBASE_name'] == option].iloc[0]['New_class']}: PDB [{pdb_code.upper()}](https://www.rcsb.org/structure/{pdb_code}) (Chain {hl_chain})")
+        st.markdown(
+            f"## MTase {option} from class {row['New_class']}: PDB [{pdb_code.upper()}](https://www.rcsb.org/structure/{pdb_code}) (Chain {hl_chain})")
 
 
 ### Step 3) Py3Dmol
@@ -125,9 +204,16 @@ if k!= 0:
     st.write('MTase chain is yellow. Sam-motif and cat-motif are blue.\
      Elements detected by hmm-profiles are red.\
      Loops between detected elements are green.')
+    # structures are served from the local store, only codes missing there are fetched by the browser
     if uploaded_file_pdb is not None and not pdb_code:
-        view = stmol.obj_upload(uploaded_file_pdb)
+        structure = structures.uploaded_structure(uploaded_file_pdb.getvalue(), uploaded_file_pdb.name)
+    else:
+        structure = structures.load_structure(pdb_code)
+    if structure is not None:
+        view = py3Dmol.view(width=width, height=height)
+        view.addModel(*structure)
     else:
+        st.sidebar.warning(f"Structure {pdb_code.upper()} is not in the local store, it is loaded from RCSB PDB")
         view = py3Dmol.view(query=f"pdb:{pdb_code.lower()}", width=width, height=height)
 
     view.setStyle({"cartoon": {"style": "oval","color": bb_color,"thickness": cartoon_radius}})
@@ -151,7 +237,7 @@ if k!= 0:
         for hl_resi in hl_resi_list:
             view.addResLabels({"chain": hl_chain,"resi": hl_resi},
             {"backgroundColor": "lightgray","fontColor": "black","backgroundOpacity": 0.5})
-    color_MTase(df)
+    color_MTase(row)
 
     showmol(view, height=height, width=width)
 
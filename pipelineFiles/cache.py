@@ -0,0 +1,127 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from pipeline import PROFILES_PATH, REGIONS_PATH
+
+# directory and size limit of the result cache, private to the user running the app
+CACHE_DIR = os.environ.get('MTASE_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'mtase-pipeline', 'results'))
+MAX_CACHE_BYTES = int(os.environ.get('MTASE_CACHE_BYTES', 2**30))
+
+RESULT_FILES = ['regions.parquet', 'class.parquet', 'several_cat_domains.parquet']
+
+# digests of files by (path, size, modification time)
+_file_digests = dict()
+
+
+# function for calculating sha256 digest of a file, unchanged files are not read again
+def file_digest(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(2**20), b''):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+# function for making cache key from uploaded sequences, profiles and profile regions
+# changing profile or region definition files or hmmsearch size options gives new keys
+def cache_key(fasta, profiles=PROFILES_PATH, regions=REGIONS_PATH, search_options=()):
+    digest = hashlib.sha256(fasta)
+    digest.update(file_digest(profiles).encode())
+    digest.update(file_digest(regions).encode())
+    digest.update(' '.join(map(str, search_options)).encode())
+    return digest.hexdigest()
+
+
+# function for writing result table as parquet
+# object columns mixing numbers and strings (Model_ID of numbered and named profiles) are written
+# as strings, rows of numbers are kept in the table attributes to restore them on reading
+def write_table(df, path):
+    df = df.copy()
+    int_rows = dict()
+    for column in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[column], skipna=True) == 'mixed-integer':
+            int_rows[column] = np.flatnonzero(df[column].map(lambda x: isinstance(x, (int, np.integer)))).tolist()
+            df[column] = df[column].astype(str)
+    df.attrs = dict(int_rows=int_rows)
+    df.to_parquet(path)
+
+
+def read_table(path):
+    df = pd.read_parquet(path)
+    for column, rows in df.attrs.get('int_rows', dict()).items():
+        values = df[column].to_numpy(dtype=object, copy=True)
+        values[rows] = [int(value) for value in values[rows]]
+        df[column] = values
+    df.attrs = dict()
+    return df
+
+
+# function for loading cached region, class and several cat-domain tables, None if not cached
+def load_results(key):
+    entry = os.path.join(CACHE_DIR, key)
+    try:
+        results = tuple(read_table(os.path.join(entry, name)) for name in RESULT_FILES)
+        # mark the entry as recently used
+        os.utime(entry)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return results
+
+
+# function for storing hmmsearch alignments and result tables, then evicting least recently used entries
+def store_results(key, stk, results):
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=CACHE_DIR, prefix='.tmp-')
+    try:
+        if os.path.exists(stk):
+            shutil.copyfile(stk, os.path.join(tmpdir, 'file.stk'))
+        for name, df in zip(RESULT_FILES, results):
+            write_table(df, os.path.join(tmpdir, name))
+        # an entry appears at once, so readers never see it half written
+        os.rename(tmpdir, os.path.join(CACHE_DIR, key))
+    except OSError:
+        # the same results were stored by another job
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    evict()
+
+
+# function for calculating size of a directory in bytes, files removed meanwhile are not counted
+def _dir_size(path):
+    size = 0
+    for root, _dirs, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+# function for removing least recently used entries while the cache is larger than MAX_CACHE_BYTES
+def evict(max_bytes=None):
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if not name.startswith('.'):
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+            except FileNotFoundError:
+                # evicted by another job
+                continue
+    total = sum(size for _mtime, size, _path in entries)
+    for _mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -1,45 +1,71 @@
 #! /usr/bin/env python3
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
+import string
 import argparse
+import heapq
+import os
+import tempfile
+from contextlib import ExitStack
+from itertools import chain
 
-# function for calculating percent of aligned aa
-def aligned_percent(frags):
-    return len(re.findall(r'[A-Z]',frags))/(len(re.findall(r'-',frags))+len(re.findall(r'[A-Z]',frags)))
+from metrics import Metrics, count, stage
 
-# function for calculating ration between aligned aa and inserted aa
-def letter_percent(frags):
-    return (len(re.findall(r'[A-Za-z]',frags)))/len(re.findall(r'[A-Z]',frags))
+# byte classes of fragment characters: 1 - aligned aa, 2 - inserted aa, 3 - gap
+FRAG_CLASSES = np.zeros(256, dtype=np.intp)
+FRAG_CLASSES[np.frombuffer(string.ascii_uppercase.encode(), dtype=np.uint8)] = 1
+FRAG_CLASSES[np.frombuffer(string.ascii_lowercase.encode(), dtype=np.uint8)] = 2
+FRAG_CLASSES[ord('-')] = 3
+
+# function for counting aligned aa, inserted aa and gaps in all fragments at once
+def fragment_stats(frags):
+    frags = frags.astype(str)
+    lengths = frags.str.len().to_numpy()
+    # classify every byte of the concatenated fragments and count classes per row
+    buf = np.frombuffer(''.join(frags).encode('ascii', 'replace'), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    counts = np.bincount(rows * 4 + FRAG_CLASSES[buf], minlength=4 * len(lengths)).reshape(-1, 4)
+    return counts[:, 1], counts[:, 2], counts[:, 3]
 
 # function for region filtration - step 1 in pipline step 3
-def region_filtration(df):
+def region_filtration(df, metrics=None):
+    count(metrics, 'region_filtration.rows_in', len(df))
     #bring all values into a single format
-    df['Model_ID'] = df['Model_ID'].apply(lambda x: int(x) if isinstance(x, str) and x[0] == '0' else x)
+    df['Model_ID'] = df['Model_ID'].astype(object).apply(lambda x: int(x) if isinstance(x, str) and x[0] == '0' else x)
     # Filter region alignments that contain only gaps.
     df = df[df['Region_coords'].notnull()]
+    count(metrics, 'region_filtration.aligned', len(df))
     # Create region start coordinate column.
-    df['region_first'] = df['Region_coords'].apply(lambda x: int(x.split('-')[0]))
+    if 'Region_start' in df:
+        df['region_first'] = df['Region_start'].astype('int64')
+    else:
+        df['region_first'] = df['Region_coords'].apply(lambda x: int(x.split('-')[0]))
     # Sort regions for each protein and model by value from column "region_first"
     df = df.sort_values(by=['REBASE_name', 'Model_ID', 'region_first'])
-    # calculating percent of aligned aa
-    df['aligned_percent'] = df['Alignment_frags'].apply(lambda x: aligned_percent(x))
-    # function for calculating ration between aligned aa and inserted aa
-    df['letter_percent'] = df['Alignment_frags'].apply(lambda x: letter_percent(x))
-    # filter aligned_percent more than 0.4
-    df = df[df['aligned_percent'] > 0.4]
-    # filter aligned_percent more than 2.5
-    df = df[df['letter_percent'] < 2.5]
-    # filter not full-length sam_motif
-    df = df[~((df['Region_name'] == 'sam_motif') & ((df['aligned_percent'] < 0.75) | (df['Alignment_frags'].str.count('-') > 1)))]
-    # filter not full-length sam_motif
-    df = df[~((df['Region_name'] == 'cat_motif') & ((df['aligned_percent'] < 0.75) | (df['Alignment_frags'].str.count('-') > 1)))]
+    upper, lower, gaps = fragment_stats(df['Alignment_frags'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # calculating percent of aligned aa
+        df['aligned_percent'] = upper / (upper + gaps)
+        # calculating ration between aligned aa and inserted aa
+        df['letter_percent'] = (upper + lower) / upper
+    # filter aligned_percent more than 0.4 and letter_percent less than 2.5
+    keep = (df['aligned_percent'] > 0.4) & (df['letter_percent'] < 2.5)
+    count(metrics, 'region_filtration.aligned_percent_letter_percent', keep.sum())
+    # filter not full-length sam_motif and cat_motif
+    motif = df['Region_name'].isin(['sam_motif', 'cat_motif'])
+    keep &= ~(motif & ((df['aligned_percent'] < 0.75) | (gaps > 1)))
+    df = df[keep]
+    count(metrics, 'region_filtration.full_length_motifs', len(df))
     return df
 
 # function for region filtration - step 2 in pipline step 3
 def sequence_filtration(df):
     # for each region and name merge all coordinates
-    df1 = df.groupby(['REBASE_name', 'Region_name'], as_index=False).agg([
+    df1 = df.groupby(['REBASE_name', 'Region_name'], as_index=False, observed=True).agg([
         lambda x: ",".join(set(re.sub('\.', '', str(i)) for i in x))
     ])
     # manipulation with table
@@ -56,77 +82,50 @@ def sequence_filtration(df):
     dfcatsam = dfcat.merge(dfsam, on='REBASE_name', suffixes=('_cat', '_sam')).filter(regex="^(?!region_first)")
     return df[~df['REBASE_name'].isin(dfcatsam['REBASE_name'])], dfcatsam
 
-#filter out region sets where Hu2-S1 or Hd2-Hd3 in the start.
-#Hu2-S1 or Hd2-Hd3 could not be at the beginning of the sequence as they should follow cat- or sam-motif
-def filter_dublicates_1(x, y):
-    reg = x.split(',')
-    if reg[0] == 'Hu2-S1' and reg.count('Hu2-S1') > 1:
-        return ','.join(reg[1:])
-    if reg[0] == 'Hd2-Hd3' and reg.count('Hd2-Hd3') > 1:
-        return ','.join(reg[1:])
-    else:
-        return x
-
-#filter out region sets where Hu2-S1 or Hd2-Hd3 at the beginning of the sequence.
-#Hu2-S1 or Hd2-Hd3 could at the beginning of the sequence as they should follow cat- or sam-motif
-def filter_dublicates_2(x, y):
-    reg = x.split(',')
-    if reg[0] == 'Hu2-S1' and reg.count('Hu2-S1') > 1:
-        return ','.join(y.split(',')[1:])
-    if reg[0] == 'Hd2-Hd3' and reg.count('Hd2-Hd3') > 1:
-        return ','.join(y.split(',')[1:])
-    else:
-        return y
-
-#filter out region sets where Hd1-S5 or S7-S4 at the end of the sequence.
+#cut out false regions from the start and the end of the region set.
+#Hu2-S1 or Hd2-Hd3 could not be at the beginning of the sequence as they should follow cat- or sam-motif,
 #Hd1-S5 or S7-S4 could not be at the end of the sequence as they should be followed sam- or cat-motif
-def filter_dublicates_3(x, y):
-    reg = x.split(',')
-    if reg[-1] == 'Hd1-S5' and reg.count('Hd1-S5') > 1:
-        return ','.join(reg[:-1])
-    if reg[-1] == 'S7-S4' and reg.count('S7-S4') > 1:
-        return ','.join(reg[:-1])
-    else:
-        return x
-
-#filter out region sets where Hu2-S1 or S7-S4 at the end of the sequence.
-#Hu2-S1 or S7-S4 could not be at the end of the sequence as they should be followed sam- or cat-motif
-def filter_dublicates_4(x, y):
-    reg = x.split(',')
-    if reg[-1] == 'Hu2-S1' and reg.count('Hu2-S1') > 1:
-        return ','.join(y.split(',')[:-1])
-    if reg[-1] == 'S7-S4' and reg.count('S7-S4') > 1:
-        return ','.join(y.split(',')[:-1])
-    else:
-        return y
-    
+def trim_region_set(names, coords):
+    if names[0] in ('Hu2-S1', 'Hd2-Hd3') and names.count(names[0]) > 1:
+        names = names[1:]
+        coords = coords[1:]
+    last = names[-1]
+    if names.count(last) > 1:
+        if last in ('Hu2-S1', 'S7-S4'):
+            coords = coords[:-1]
+        if last in ('Hd1-S5', 'S7-S4'):
+            names = names[:-1]
+    return names, coords
+
 # function for making set of regions - step 3 in pipline step 3
 def set_of_regions(df):
-    # for each region and model merge all coordinates, region names, aligned percent
-    df = df[['REBASE_name', 'Model_ID', 'Region_name', 'Region_coords', 'aligned_percent']].groupby(
-        ['REBASE_name', 'Model_ID'], as_index=False).agg([
-        lambda x: ",".join(str(i) for i in x)
-    ])
-    # manipulation with table
-    df = df.reset_index()
-    df.columns = df.columns.droplevel(1)
-
-    #filter region names that comtain only one sam-motif and only one cat-motif
-    df = df[(df['Region_name'].str.count('sam_motif') == 1) & (df['Region_name'].str.count('cat_motif') == 1)]
+    # for each protein and model collect region names, coordinates and aligned percent as lists
+    df = df.assign(Region_coords=df['Region_coords'].str.split(','))
+    df = df.groupby(['REBASE_name', 'Model_ID'], as_index=False).agg(
+        Region_name=('Region_name', list),
+        Region_coords=('Region_coords', lambda x: list(chain.from_iterable(x))),
+        aligned_percent=('aligned_percent', list))
+    # filter region sets that contain only one sam-motif and only one cat-motif
+    df = df[np.array([names.count('sam_motif') == 1 and names.count('cat_motif') == 1
+                     for names in df['Region_name']], dtype=bool)]
 
-    #cut out false regions
-    df['Region1'] = df.apply(lambda x: filter_dublicates_1(x['Region_name'], x['Region_coords']), axis=1)
-    df['Region_coord1'] = df.apply(lambda x: filter_dublicates_2(x['Region_name'], x['Region_coords']), axis=1)
-    df['Regions'] = df.apply(lambda x: filter_dublicates_3(x['Region1'], x['Region_coord1']), axis=1)
-    df['Region_coords'] = df.apply(lambda x: filter_dublicates_4(x['Region1'], x['Region_coord1']), axis=1)
+    # cut out false regions
+    region_sets = [trim_region_set(names, coords) for names, coords in zip(df['Region_name'], df['Region_coords'])]
+    df = df.assign(Regions=[names for names, _ in region_sets],
+                   Region_coords=[coords for _, coords in region_sets])
     df = df[['REBASE_name', 'Model_ID', 'Regions', 'Region_coords', 'aligned_percent']]
-    
+
     #count number of regions-1
-    df['Region_count'] = df['Regions'].str.count(',')
+    df['Region_count'] = [len(names) - 1 for names in df['Regions']]
 
     #calculate average aligned percent for all regions
-    df['Aligned_percent'] = df['aligned_percent'].apply(
-        lambda x: sum([float(x) for x in x.split(',')]) / len(x.split(',')))
+    df['Aligned_percent'] = [sum(x) / len(x) for x in df['aligned_percent']]
+    return df
+
+# function for joining region sets into comma-separated strings for output
+def format_region_sets(df):
+    for column in ['Regions', 'Region_coords', 'aligned_percent']:
+        df[column] = [','.join(str(i) for i in x) for x in df[column]]
     return df
 
 #function for choosing best profile  - step 4 in pipline step 3
@@ -135,36 +134,187 @@ def best_profile(df):
     df3 = df2.merge(df2.groupby(["REBASE_name"])["Aligned_percent"].max().reset_index())
     return df3
 
+# features of region sets used by class assignment rules
+def region_set_features(df):
+    rows = np.arange(len(df))
+    # every region name and coordinate with its position in the region set
+    names = pd.Series(list(df['Regions']), index=rows, dtype=object).explode()
+    positions = names.groupby(level=0).cumcount()
+    coords = pd.Series(list(df['Region_coords']), index=rows, dtype=object).explode()
+    coords.index = pd.MultiIndex.from_arrays([coords.index, coords.groupby(level=0).cumcount()])
+
+    def first_position(name):
+        return positions[names == name].groupby(level=0).first().reindex(rows)
+
+    def region_coords(name):
+        found = first_position(name).dropna().astype(int)
+        values = coords.reindex(pd.MultiIndex.from_arrays([found.index, found])).astype(object)
+        values.index = found.index
+        return values.reindex(rows)
+
+    features = pd.DataFrame(index=rows)
+    features['cat_before_sam'] = first_position('cat_motif') < first_position('sam_motif')
+    features['starts_with_Hd1'] = names[positions == 0].str[:3].eq('Hd1').reindex(rows, fill_value=False)
+    # distance between the end of Hd2-Hd3 and the start of S7-S4
+    features['S7-S4_gap'] = (pd.to_numeric(region_coords('S7-S4').str.split('-').str[0])
+                             - pd.to_numeric(region_coords('Hd2-Hd3').str.split('-').str[-1]))
+    return features
+
+# class assignment rules: profile family -> class or function choosing class by region set features
+CLASS_RULES = [
+    ([54378, 51816, 52618, 53087], 'A'),
+    ([36976, 37952, 45988, 48856, 52484],
+     lambda f: np.where(f['cat_before_sam'], 'B', np.where(f['S7-S4_gap'] < 50, 'E', 'D'))),
+    ([46303, 46923, 45633], lambda f: np.where(f['starts_with_Hd1'], 'F', 'C')),
+    (['New-MTase-profile'], 'J'),
+    (['Dam'], 'H'),
+    (['EcoRI_methylase'], 'I'),
+    (['MT-A70'], 'G'),
+]
+
 #function for class assignment - step 5 in pipline step 3
-def assign_class(model_id, regions, region_coords):
-    if model_id in [54378, 51816, 52618, 53087] and regions.count(',') > 2:
-        return 'A'
-    if model_id in [36976, 37952, 45988, 48856, 52484] and regions.count(',') > 2:
-        if regions.find('cat_motif') < regions.find('sam_motif'):
-            return 'B'
-        if regions.find('cat_motif') > regions.find('sam_motif'):
-            if 'Hd2-Hd3' in regions and 'S7-S4' in regions:
-                if int(region_coords.split(',')[regions.split(',').index('S7-S4')].split('-')[0]) - \
-                int(region_coords.split(',')[regions.split(',').index('Hd2-Hd3')].split('-')[-1]) < 50:
-                    return 'E'
-                else:
-                    return 'D'
-            else:
-                return 'D'
-    if model_id in [46303, 46923, 45633] and regions.count(',') > 2:
-        if regions[:3] == 'Hd1':
-            return 'F'
-        else:
-            return 'C'
-    if model_id in ["New-MTase-profile"] and regions.count(',') > 2:
-        return "J"
-    if model_id in ["Dam"] and regions.count(',') > 2:
-        return "H"
-    if model_id in ["EcoRI_methylase"] and regions.count(',') > 2:
-        return "I"
-    if model_id in ["MT-A70"] and regions.count(',') > 2:
-        return "G"
-    return '-'
+def assign_class(df):
+    features = region_set_features(df)
+    classes = np.full(len(df), '-', dtype=object)
+    # only region sets with more than three regions get a class
+    unassigned = (df['Region_count'] > 2).to_numpy()
+    for model_ids, rule in CLASS_RULES:
+        mask = unassigned & df['Model_ID'].isin(model_ids).to_numpy()
+        classes[mask] = rule if isinstance(rule, str) else rule(features)[mask]
+        unassigned &= ~mask
+    return classes
+
+# function for running all steps of pipline step 3 on the region table
+# stage timings and row counts are added to metrics if given
+def classify(df, metrics=None):
+    #step 1 in pipline step 3
+    with stage(metrics, 'region_filtration'):
+        df = region_filtration(df, metrics)
+    # step 2 in pipline step 3
+    with stage(metrics, 'sequence_filtration'):
+        df, several_cat_domains = sequence_filtration(df)
+    count(metrics, 'sequence_filtration.rows_kept', len(df))
+    count(metrics, 'proteins_with_several_cat_domains', several_cat_domains['REBASE_name'].nunique())
+    # step 3 in pipline step 3
+    with stage(metrics, 'set_of_regions'):
+        df = set_of_regions(df)
+    count(metrics, 'region_sets', len(df))
+    # step 4 in pipline step 3
+    with stage(metrics, 'best_profile'):
+        df = best_profile(df)
+    # step 5 in pipline step 3
+    with stage(metrics, 'assign_class'):
+        df['New_class'] = assign_class(df)
+    count(metrics, 'proteins_classified', df.loc[df['New_class'] != '-', 'REBASE_name'].nunique())
+    return format_region_sets(df), several_cat_domains
+
+# text columns of TSV region tables are read as strings, as dtypes inferred from a chunk
+# where all values are empty would be float
+TEXT_DTYPES = {'REBASE_name': str, 'Region_coords': str, 'Alignment_frags': str}
+
+# sorted part tables merged at once by classify_stream
+MAX_OPEN_TABLES = 64
+
+# function for reading region table in TSV, Parquet or Arrow IPC (.arrow, .feather) format
+def read_region_table(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith(('.arrow', '.feather')):
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep='\t', dtype=TEXT_DTYPES)
+
+# function for reading region table in chunks of chunk_size rows
+def iter_region_table(path, chunk_size):
+    if path.endswith('.parquet'):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif path.endswith(('.arrow', '.feather')):
+        # Arrow IPC files are read by the record batches they were written with
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+    else:
+        yield from pd.read_csv(path, sep='\t', chunksize=chunk_size, dtype=TEXT_DTYPES)
+
+# function for counting rows of region table without reading it
+def count_region_rows(path):
+    if path.endswith('.parquet'):
+        return pq.ParquetFile(path).metadata.num_rows
+    if path.endswith(('.arrow', '.feather')):
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    with open(path, 'rb') as infile:
+        return max(sum(1 for _line in infile) - 1, 0)
+
+# function for appending rows of region table chunks to bucket files by hash of REBASE_name
+# all rows of a protein go to one bucket, so the region table does not have to be sorted
+# (get_aln_regions writes Parquet and Arrow tables in profile block order)
+def partition_region_table(chunks, paths):
+    started = set()
+    for chunk in chunks:
+        names = chunk['REBASE_name'].astype(str)
+        buckets = pd.util.hash_pandas_object(names, index=False).to_numpy() % len(paths)
+        for bucket, part in chunk.groupby(buckets):
+            part.to_csv(paths[bucket], sep='\t', index=False, mode='a', header=bucket not in started)
+            started.add(bucket)
+        if not started:
+            # an empty table still writes output headers
+            chunk.to_csv(paths[0], sep='\t', index=False)
+            started.add(0)
+    return [path for i, path in enumerate(paths) if i in started]
+
+# function for merging output tables sorted by REBASE_name (the second column) into one sorted table
+# with renumber rows are numbered again from 0 as in a full in-memory run
+def merge_tables(paths, output, renumber=True):
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(path)) for path in paths]
+        headers = [next(infile) for infile in files]
+        with open(output, 'w') as outfile:
+            outfile.write(headers[0])
+            rows = heapq.merge(*files, key=lambda line: line.split('\t', 2)[1])
+            for i, line in enumerate(rows):
+                if renumber:
+                    line = str(i) + line[line.index('\t'):]
+                outfile.write(line)
+
+# function for merging many sorted tables, at most MAX_OPEN_TABLES files are open at once
+def merge_sorted_tables(paths, output, tmpdir):
+    round_number = 0
+    while len(paths) > MAX_OPEN_TABLES:
+        merged = []
+        for i in range(0, len(paths), MAX_OPEN_TABLES):
+            path = os.path.join(tmpdir, f'merge{round_number}_{i}.tsv')
+            merge_tables(paths[i:i + MAX_OPEN_TABLES], path, renumber=False)
+            merged.append(path)
+        paths = merged
+        round_number += 1
+    merge_tables(paths, output)
+
+# function for running pipline step 3 bucket by bucket, buckets have about chunk_size rows
+# the region table is read in chunks twice (counting and partitioning), so peak memory depends on
+# chunk size, not on the region table size; outputs are the same as of a full in-memory run
+def classify_stream(path, class_output, more_than_one_cat_domain, chunk_size, metrics=None):
+    n_buckets = max(1, -(-count_region_rows(path) // chunk_size))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        buckets = [os.path.join(tmpdir, f'bucket{i}.tsv') for i in range(n_buckets)]
+        with stage(metrics, 'partition_region_table'):
+            buckets = partition_region_table(iter_region_table(path, chunk_size), buckets)
+        class_parts = []
+        several_parts = []
+        for bucket in buckets:
+            chunk = read_region_table(bucket)
+            os.remove(bucket)
+            count(metrics, 'region_rows', len(chunk))
+            df, several_cat_domains = classify(chunk, metrics)
+            class_parts.append(bucket[:-len('.tsv')] + '_class.tsv')
+            several_parts.append(bucket[:-len('.tsv')] + '_several.tsv')
+            df.to_csv(class_parts[-1], sep='\t')
+            several_cat_domains.to_csv(several_parts[-1], sep='\t')
+        with stage(metrics, 'merge_outputs'):
+            merge_sorted_tables(class_parts, class_output, tmpdir)
+            merge_sorted_tables(several_parts, more_than_one_cat_domain, tmpdir)
 
 def main():
     #make parser
@@ -173,25 +323,32 @@ def main():
     parser.add_argument("--table-with-profile-region-hits")
     parser.add_argument("--more-than-one-cat-domain")
     parser.add_argument("--class-output")
+    parser.add_argument("--chunk-size", type=int, metavar="N",
+                        help="classify the region table in parts of about N rows, "
+                             "the table does not have to be sorted")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write stage timings, peak memory and row counts as JSON")
+    parser.add_argument("--profile", metavar="FILE", help="write cProfile dump of the run")
+    parser.add_argument("--memory-dump", metavar="FILE",
+                        help="trace memory with tracemalloc and write largest allocations")
     args = parser.parse_args()
     #print(args)
-    df = pd.read_csv(args.table_with_profile_region_hits, sep='\t')
-    #step 1 in pipline step 3
-    df = region_filtration(df)
-    # step 2 in pipline step 3
-    t = sequence_filtration(df)
-    t[1].to_csv(args.more_than_one_cat_domain, sep='\t')
-    # step 3 in pipline step 3
-    df = set_of_regions(t[0])
-    # step 4 in pipline step 3
-    df = best_profile(df)
-    # step 5 in pipline step 3
-    df['New_class'] = df.apply(lambda x: assign_class(x[1], x[2], x[3]), axis=1)
-    df.to_csv(args.class_output, sep='\t')
+    metrics = Metrics(args.profile, args.memory_dump)
+    if args.chunk_size:
+        classify_stream(args.table_with_profile_region_hits, args.class_output,
+                        args.more_than_one_cat_domain, args.chunk_size, metrics)
+    else:
+        with metrics.stage('read_region_table'):
+            df = read_region_table(args.table_with_profile_region_hits)
+        metrics.count('region_rows', len(df))
+        df, several_cat_domains = classify(df, metrics)
+        several_cat_domains.to_csv(args.more_than_one_cat_domain, sep='\t')
+        df.to_csv(args.class_output, sep='\t')
+    metrics.finish()
+    if args.metrics:
+        metrics.write(args.metrics)
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
     main()
     print('Finish')
-
-
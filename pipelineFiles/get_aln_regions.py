@@ -1,45 +1,54 @@
 #! /usr/bin/env python3
 
+import argparse
 import gzip
+import multiprocessing
 import sys
 import signal
-from itertools import chain
+from itertools import accumulate
 import sys
 #sys.path.append('./etsv/src/etsv')
 #print(sys.path)
 #sys.path.append('/home/adminuser/venv/src/etsv/src')
 sys.path.append('./etsv_ms')
 import etsv  
+import pandas as pd
 
+import stkindex
+from metrics import Metrics
 
-def hmm2aln(aln, hmm_coord):
-    for i, n in enumerate(aln, 1):
-        if n == "-" or n.isupper():
-            hmm_coord -= 1
-        if hmm_coord == 0:
-            return i
+
+def coord_maps(aln):
+    # 1-based alignment columns of HMM match states, one per HMM position
+    match_cols = [i for i, n in enumerate(aln, 1) if n == "-" or n.isupper()]
+    # number of protein residues in the first N alignment columns
+    res_counts = list(accumulate((n not in "-." for n in aln), initial=0))
+    return match_cols, res_counts
+
+
+def hmm2aln(match_cols, hmm_coord):
+    if 0 < hmm_coord <= len(match_cols):
+        return match_cols[hmm_coord-1]
     raise IndexError(f"HMM coordinate is out of range ({hmm_coord})")
 
 
-def aln2prot(aln, start, aln_coord, from_coord=True):
-    start -= 1
-    for n in aln[:aln_coord]:
-        if n not in "-.":
-            start += 1
+def aln2prot(aln, res_counts, start, aln_coord, from_coord=True):
+    start += res_counts[aln_coord] - 1
     if from_coord and aln[aln_coord-1] in "-.":
         start += 1
     return start
 
 
-def cut_region(aln, start, hmm_coords):
+def cut_region(aln, start, hmm_coords, maps=None):
+    match_cols, res_counts = maps or coord_maps(aln)
     aln_frags = []
     prot_coords = []
     for hmm_from, hmm_to in hmm_coords:
-        aln_from = hmm2aln(aln, hmm_from)
-        aln_to = hmm2aln(aln, hmm_to)
+        aln_from = hmm2aln(match_cols, hmm_from)
+        aln_to = hmm2aln(match_cols, hmm_to)
         aln_frags.append(aln[aln_from-1:aln_to])
-        prot_from = aln2prot(aln, start, aln_from)
-        prot_to = aln2prot(aln, start, aln_to, False)
+        prot_from = aln2prot(aln, res_counts, start, aln_from)
+        prot_to = aln2prot(aln, res_counts, start, aln_to, False)
         if prot_from <= prot_to:
             prot_coords.append(f"{prot_from}-{prot_to}")
     return ",".join(aln_frags), ",".join(prot_coords)
@@ -58,78 +67,290 @@ def format_coordset(coordset):
     return ",".join(f"{f}-{t}" for f, t in coordset)
 
 
-def process_alignments(instk, outsv, regions):
+def read_stockholm(instk, hmmids=None):
+    """Yield (hmmid, seqid, aligned_string) records from Stockholm alignments.
+
+    Sequence lines may be wrapped over several interleaved blocks, their
+    fragments are collected and joined once at the `//` line. Alignments
+    with an ID not in `hmmids` (if given) are skipped.
+    """
     hmmid = None
-    reg_coords = None
-    process_hmm = True
-    alns = dict()
-    with instk:
-        for line in instk:
-            if line.startswith("#"):
-                if line.startswith("#=GF ID"):
-                    hmmid = line[8:-1]
-                    process_hmm = hmmid in regions
-                    if process_hmm:
-                        reg_coords = regions[hmmid]
-                continue
-            if line.startswith("//"):
-                for seqid, aln in alns.items():
-                    nm, coords_str = seqid.split("/", 1)
-                    hit_id = ":".join((nm, hmmid, coords_str))
-                    prot_from, _prot_to = parse_coords(coords_str)
-                    for region, hmm_coords in reg_coords:
-                        aln_frags, prot_coords = cut_region(aln, prot_from,
-                                                            hmm_coords)
-                        outsv.write_entry(vars())
-                hmmid = None
-                alns = dict()
-                continue
+    keep = True
+    frags = dict()
+    for line in instk:
+        tag = line[:2]
+        if tag == "#=":
+            if line[:7] == "#=GF ID":
+                hmmid = line[8:].strip()
+                keep = hmmids is None or hmmid in hmmids
+        elif tag == "//":
+            for seqid, parts in frags.items():
+                yield hmmid, seqid, "".join(parts)
+            hmmid = None
+            keep = True
+            frags = dict()
+        elif keep and tag[:1] != "#":
             line = line.strip()
-            if process_hmm and line:
+            if line:
                 seqid, aln = line.split(maxsplit=1)
-                alns[seqid] = alns.get(seqid, "") + aln
+                frags.setdefault(seqid, []).append(aln)
+
+
+def cut_regions(records, regions):
+    for hmmid, seqid, aln in records:
+        nm, coords_str = seqid.split("/", 1)
+        hit_id = ":".join((nm, hmmid, coords_str))
+        prot_from, _prot_to = parse_coords(coords_str)
+        maps = coord_maps(aln)
+        for region, hmm_coords in regions[hmmid]:
+            aln_frags, prot_coords = cut_region(aln, prot_from,
+                                                hmm_coords, maps)
+            # values in the order of REGION_FIELDS
+            yield (hit_id, nm, hmmid, region, coords_str, prot_coords,
+                   hmm_coords, aln_frags)
+
+
+def iter_blocks(instk):
+    """Split a Stockholm stream into `//`-terminated blocks of lines."""
+    block = []
+    for line in instk:
+        block.append(line)
+        if line[:2] == "//":
+            yield block
+            block = []
+
+
+_worker_regions = None
+
+
+def _init_worker(regions):
+    global _worker_regions # pylint: disable=global-statement
+    _worker_regions = regions
+
+
+def _process_block(block):
+    records = read_stockholm(block, _worker_regions)
+    return list(cut_regions(records, _worker_regions))
+
+
+def _process_block_range(task):
+    path, offset, length = task
+    return _process_block(stkindex.read_block(path, offset, length))
+
+
+def iter_indexed_region_rows(path, regions, jobs=1, names=None):
+    """Yield region rows of a plain or BGZF Stockholm file using its index.
+
+    Only blocks of profiles in `regions` are read, workers read their
+    blocks from the file by offset. With `names` only hits of these
+    proteins are read, line by line.
+    """
+    blocks = [block for block in stkindex.load_index(path)
+              if block.hmmid in regions]
+    if names is not None:
+        for block in blocks:
+            lines = [f"#=GF ID {block.hmmid}\n"]
+            for seqid, offsets in block.seqs.items():
+                if seqid.split("/", 1)[0] in names:
+                    lines += stkindex.read_seq_lines(path, offsets)
+            lines.append("//\n")
+            yield from cut_regions(read_stockholm(lines), regions)
+    elif jobs > 1:
+        tasks = [(path, block.offset, block.length) for block in blocks]
+        with multiprocessing.Pool(jobs, _init_worker, (regions,)) as pool:
+            for rows in pool.imap(_process_block_range, tasks):
+                yield from rows
+    else:
+        for block in blocks:
+            lines = stkindex.read_block(path, block.offset, block.length)
+            yield from cut_regions(read_stockholm(lines), regions)
+
+
+def iter_region_rows(instk, regions, jobs=1):
+    if jobs > 1:
+        # blocks (one per profile) are independent, imap keeps their order
+        with multiprocessing.Pool(jobs, _init_worker, (regions,)) as pool:
+            for rows in pool.imap(_process_block, iter_blocks(instk)):
+                yield from rows
+    else:
+        yield from cut_regions(read_stockholm(instk, regions), regions)
+
+
+def write_region_rows(rows, outsv):
+    """Write region rows, return numbers of hits and rows written."""
+    counts = [0, 0]
 
+    def counted(rows):
+        hit_id = None
+        for row in rows:
+            counts[1] += 1
+            # rows of one hit are consecutive
+            if row[0] != hit_id:
+                hit_id = row[0]
+                counts[0] += 1
+            yield row
 
-def load_regions(intsv):
+    outsv.write_entries(counted(rows))
+    return tuple(counts)
+
+
+def process_alignments(instk, outsv, regions, jobs=1):
+    with instk:
+        return write_region_rows(iter_region_rows(instk, regions, jobs), outsv)
+
+
+def process_indexed_alignments(path, outsv, regions, jobs=1, names=None):
+    return write_region_rows(
+        iter_indexed_region_rows(path, regions, jobs, names), outsv)
+
+
+def region_frame(instk, regions, jobs=1, typed=False, rows=None):
+    """Collect region rows into a DataFrame with the region table columns.
+
+    Regions without aligned residues get a missing `Region_coords` value,
+    as if the table had been written as TSV and read back by pandas.
+    With `typed` the frame also gets integer `Alignment_start/end` and
+    `Region_start/end` columns, and `Model_ID` and `Region_name` become
+    categorical, so no text has to be parsed downstream. Already cut
+    `rows` are used instead of reading `instk` if given.
+    """
+    if rows is None:
+        rows = iter_region_rows(instk, regions, jobs)
+    columns = list(zip(*rows)) or [()] * len(REGION_FIELDS)
+    df = pd.DataFrame({
+        str(field): field.format_column(column)
+        for field, column in zip(REGION_FIELDS, columns)
+    }, dtype=object)
+    df["Region_coords"] = df["Region_coords"].mask(df["Region_coords"] == "")
+    if typed:
+        df["Model_ID"] = df["Model_ID"].astype("category")
+        df["Region_name"] = df["Region_name"].astype("category")
+        bounds = df["Alignment_coords"].str.extract(r"^(\d+)-(\d+)$")
+        df["Alignment_start"] = bounds[0].astype("int64")
+        df["Alignment_end"] = bounds[1].astype("int64")
+        # start of the first and end of the last part of the region
+        bounds = df["Region_coords"].str.extract(r"^(\d+)-.*?(\d+)$")
+        df["Region_start"] = bounds[0].astype("Int64")
+        df["Region_end"] = bounds[1].astype("Int64")
+    return df
+
+
+def load_regions(rows):
     regions = dict()
-    for vals in intsv:
-        hmmid = vals["hmmid"]
-        region = vals["region"]
-        hmm_coordset = vals["coords"]
+    for hmmid, region, hmm_coordset in rows:
         regions.setdefault(hmmid, []).append((region, hmm_coordset))
     return regions
 
 
+def read_regions(path):
+    with open(path) as intsv_obj:
+        intsv = etsv.ETSVReader(intsv_obj, [
+            etsv.InputField("hmmid", 0),
+            etsv.InputField("region", "Region_name"),
+            etsv.InputField("coords", "Region_coords_HMM", parse_coordset),
+        ])
+        return load_regions(intsv.iter_tuples())
+
+
+REGION_FIELDS = [
+    etsv.OutputField("hit_id", "Hit_ID"),
+    etsv.OutputField("nm", "REBASE_name"),
+    etsv.OutputField("hmmid", "Model_ID"),
+    etsv.OutputField("region", "Region_name"),
+    etsv.OutputField("coords_str", "Alignment_coords"),
+    etsv.OutputField("prot_coords", "Region_coords"),
+    etsv.OutputField("hmm_coords", "Region_coords_HMM", format_coordset),
+    etsv.OutputField("aln_frags", "Alignment_frags"),
+]
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: <script> regions.tsv hmmsearch.stk[.gz]")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Cut profile regions out of hmmsearch alignments.")
+    parser.add_argument("regions", metavar="regions.tsv")
+    parser.add_argument("stockholm", metavar="hmmsearch.stk[.gz]")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                        help="process profile blocks in N parallel processes")
+    parser.add_argument("--format", choices=["tsv", "parquet", "arrow"],
+                        default="tsv",
+                        help="output format, parquet and arrow (IPC file) "
+                             "tables have typed columns")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="output file, default is stdout for tsv; "
+                             "tsv files ending with .gz or .zst are "
+                             "compressed")
+    parser.add_argument("--compression", choices=["gzip", "zstd"],
+                        help="compress tsv output file, zstd requires "
+                             "the zstandard package")
+    parser.add_argument("--index", action="store_true",
+                        help="seek to profile blocks using the block index "
+                             "(built next to the file if missing), "
+                             "gzip files must be BGZF (bgzip)")
+    parser.add_argument("--names", metavar="NAME[,NAME...]",
+                        help="process only hits of these proteins, "
+                             "implies --index")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write stage timings, peak memory and row "
+                             "counts as JSON")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write cProfile dump of the run")
+    parser.add_argument("--memory-dump", metavar="FILE",
+                        help="trace memory with tracemalloc and write largest "
+                             "allocations")
+    args = parser.parse_args()
+    if args.format != "tsv" and not args.output:
+        parser.error(f"--output is required for {args.format} format")
+    if args.compression and (args.format != "tsv" or not args.output):
+        parser.error("--compression is for tsv --output files")
+    names = set(args.names.split(",")) if args.names else None
+    indexed = args.index or names is not None
+    if (indexed and args.stockholm.endswith(".gz")
+            and not stkindex.is_bgzf(args.stockholm)):
+        parser.error("indexed gzip file must be BGZF, recompress it with bgzip")
 
     try:
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     except AttributeError:
         pass # no signal.SIGPIPE on Windows
 
-    with open(sys.argv[1]) as intsv_obj:
-        intsv = etsv.ETSVReader(intsv_obj, [
-            etsv.InputField("hmmid", 0),
-            etsv.InputField("region", "Region_name"),
-            etsv.InputField("coords", "Region_coords_HMM", parse_coordset),
-        ])
-        regions = load_regions(intsv)
-    instk_name = sys.argv[2]
-    if instk_name.endswith(".gz"):
+    metrics = Metrics(args.profile, args.memory_dump)
+    with metrics.stage("read_regions"):
+        regions = read_regions(args.regions)
+    instk_name = args.stockholm
+    if indexed:
+        instk = None
+    elif instk_name.endswith(".gz"):
         instk = gzip.open(instk_name, 'rt')
     else:
         instk = open(instk_name)
-    outsv = etsv.ETSVWriter(sys.stdout, [
-        etsv.OutputField("hit_id", "Hit_ID"),
-        etsv.OutputField("nm", "REBASE_name"),
-        etsv.OutputField("hmmid", "Model_ID"),
-        etsv.OutputField("region", "Region_name"),
-        etsv.OutputField("coords_str", "Alignment_coords"),
-        etsv.OutputField("prot_coords", "Region_coords"),
-        etsv.OutputField("hmm_coords", "Region_coords_HMM", format_coordset),
-        etsv.OutputField("aln_frags", "Alignment_frags"),
-    ])
-    process_alignments(instk, outsv, regions)
+    if args.format == "tsv":
+        with (etsv.open_file(args.output, "w", args.compression)
+              if args.output else sys.stdout) as outfile:
+            outsv = etsv.ETSVWriter(outfile, REGION_FIELDS)
+            with metrics.stage("region_detection"):
+                if indexed:
+                    n_hits, n_rows = process_indexed_alignments(
+                        instk_name, outsv, regions, args.jobs, names)
+                else:
+                    n_hits, n_rows = process_alignments(instk, outsv,
+                                                        regions, args.jobs)
+    else:
+        with metrics.stage("region_detection"):
+            if indexed:
+                rows = iter_indexed_region_rows(instk_name, regions,
+                                                args.jobs, names)
+                df = region_frame(None, regions, typed=True, rows=rows)
+            else:
+                with instk:
+                    df = region_frame(instk, regions, args.jobs, typed=True)
+        n_hits, n_rows = df["Hit_ID"].nunique(), len(df)
+        with metrics.stage("write_table"):
+            if args.format == "parquet":
+                df.to_parquet(args.output, index=False)
+            else:
+                df.to_feather(args.output)
+    metrics.count("hits", n_hits)
+    metrics.count("region_rows", n_rows)
+    metrics.finish()
+    if args.metrics:
+        metrics.write(args.metrics)
@@ -0,0 +1,124 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import cache_key, file_digest, load_results, store_results
+from metrics import Metrics
+from pipeline import PROFILES_PATH, run_pipeline
+from prefilter import KMER, MOTIFS_PATH, load_index, prefilter_fasta
+from search import fasta_size, run_search
+from seqstore import SEARCH_DOMZ, SEARCH_Z, incremental_search
+
+# number of pipelines running at once and number of jobs allowed to wait for a worker
+MAX_RUNNING_JOBS = max(1, (os.cpu_count() or 1) // 4)
+MAX_QUEUED_JOBS = 16
+# cores given to hmmsearch of every running job
+JOB_CPUS = max(1, (os.cpu_count() or 1) // MAX_RUNNING_JOBS)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS, thread_name_prefix='mtase-job')
+_lock = threading.Lock()
+# jobs waiting for a worker, in queue order
+_waiting = []
+
+
+class Job:
+    """Pipeline run on uploaded sequences in its own temporary workspace."""
+
+    def __init__(self, fasta, prefilter=False, incremental=False):
+        self.fasta = fasta
+        self.prefilter = prefilter
+        self.incremental = incremental
+        # incremental search uses fixed database sizes, plain search those of the upload as hmmsearch does
+        search_options = ('-Z', SEARCH_Z, '--domZ', SEARCH_DOMZ) if incremental else ()
+        # the prefilter drops different sequences with other motifs or word length
+        search_options += ('prefilter', file_digest(MOTIFS_PATH), KMER) if prefilter else ()
+        self.key = cache_key(fasta, search_options=search_options)
+        self.cached = False
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.future = None
+        # stage timings and row counts, not collected for cached results
+        self.metrics = None
+
+    def done(self):
+        return self.future.done()
+
+    def queue_position(self):
+        """Position of the job in the queue, 0 if the job has started."""
+        with _lock:
+            return _waiting.index(self) + 1 if self in _waiting else 0
+
+
+# function for running all pipline steps of the job in its workspace
+def _run_job(job):
+    with _lock:
+        _waiting.remove(job)
+    workdir = tempfile.mkdtemp(prefix='mtase-job-')
+    job.metrics = Metrics()
+    try:
+        job.status = 'Step 1: searching MTase profiles'
+        fasta = os.path.join(workdir, 'input.fasta')
+        with open(fasta, 'wb') as outfile:
+            outfile.write(job.fasta)
+        if job.prefilter:
+            job.status = 'Step 1: motif prefilter'
+            kept_fasta = os.path.join(workdir, 'kept.fasta')
+            with job.metrics.stage('prefilter'):
+                n_seqs, n_kept = prefilter_fasta(fasta, kept_fasta, load_index())
+            job.metrics.count('sequences', n_seqs)
+            job.metrics.count('sequences_after_prefilter', n_kept)
+            fasta = kept_fasta
+            job.status = 'Step 1: searching MTase profiles'
+        stk = os.path.join(workdir, 'file.stk')
+        with job.metrics.stage('search'):
+            if job.incremental:
+                # only sequences not seen in earlier uploads are searched
+                n_seqs, n_searched = incremental_search(fasta, stk, PROFILES_PATH, cpus=JOB_CPUS)
+            else:
+                n_seqs, _n_residues = fasta_size(fasta)
+                n_searched = n_seqs
+                run_search(PROFILES_PATH, fasta, stk, JOB_CPUS)
+        if not job.prefilter:
+            job.metrics.count('sequences', n_seqs)
+        job.metrics.count('sequences_searched', n_searched)
+        job.status = 'Steps 2-3: region detection and classification'
+        # hmmsearch does not write alignments if nothing was found
+        if os.path.exists(stk):
+            with open(stk) as instk:
+                job.result = run_pipeline(instk, metrics=job.metrics)
+        else:
+            job.result = run_pipeline([], metrics=job.metrics)
+        try:
+            store_results(job.key, stk, job.result)
+        except Exception as error: # pylint: disable=broad-except
+            # results are shown anyway, only later uploads of the same sequences are not served from the cache
+            print(f'results of the job were not cached: {error}', file=sys.stderr)
+        job.status = 'finished'
+    except Exception as error: # pylint: disable=broad-except
+        job.error = error
+        job.status = 'failed'
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# function for putting uploaded fasta into the job queue
+# results for the same sequences, profiles and regions are taken from the cache without queueing
+def submit_job(fasta, prefilter=False, incremental=False):
+    job = Job(fasta, prefilter, incremental)
+    job.result = load_results(job.key)
+    if job.result is not None:
+        job.cached = True
+        job.status = 'finished'
+        job.future = Future()
+        job.future.set_result(None)
+        return job
+    with _lock:
+        if len(_waiting) >= MAX_QUEUED_JOBS:
+            raise RuntimeError('too many jobs are waiting, please try again later')
+        _waiting.append(job)
+        job.future = _executor.submit(_run_job, job)
+    return job
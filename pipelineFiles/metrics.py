@@ -0,0 +1,101 @@
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# bytes in a unit of ru_maxrss: kilobytes on Linux, bytes on macOS
+MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+# function for reading peak resident memory in MB of this process and of its finished children (hmmsearch)
+# returns (None, None) where it can not be read
+def max_rss_mb():
+    if resource is None:
+        return None, None
+    return tuple(round(resource.getrusage(who).ru_maxrss * MAXRSS_UNIT / 2**20, 1)
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+class Metrics:
+    """Timings, peak memory and row counts of pipeline stages.
+
+    Stages are timed with `stage`, counts are added with `count`; a stage
+    run several times (e.g. once per chunk) is reported once with summed
+    time and counts are summed too. With
+    `profile` a cProfile dump of the whole run is written to that file by
+    `finish`, with `memory_dump` tracemalloc peaks are added to every
+    stage and the largest allocations still held at `finish` are written
+    to that file.
+    """
+
+    def __init__(self, profile=None, memory_dump=None):
+        self.stages = []
+        self.counts = dict()
+        self._profile = profile
+        self._memory_dump = memory_dump
+        self._profiler = cProfile.Profile() if profile else None
+        if self._profiler:
+            self._profiler.enable()
+        if memory_dump:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        if self._memory_dump:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            record = next((r for r in self.stages if r['stage'] == name), None)
+            if record is None:
+                record = dict(stage=name, seconds=0)
+                self.stages.append(record)
+            record['seconds'] = round(record['seconds'] + seconds, 4)
+            # peak memory only grows, the latest value is the peak of all runs
+            record['max_rss_mb'], record['children_max_rss_mb'] = max_rss_mb()
+            if self._memory_dump:
+                peak = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                record['traced_peak_mb'] = max(peak, record.get('traced_peak_mb', 0))
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def to_dict(self):
+        return dict(stages=self.stages, counts=self.counts)
+
+    def write(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.to_dict(), outfile, indent=1)
+
+    def finish(self):
+        """Stop profiling and write the requested dumps."""
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile)
+            self._profiler = None
+        if self._memory_dump and tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().statistics('lineno')
+            tracemalloc.stop()
+            with open(self._memory_dump, 'w') as outfile:
+                for stat in stats[:50]:
+                    outfile.write(f'{stat}\n')
+
+
+# functions for timing a stage and adding a count only if metrics are collected
+def stage(metrics, name):
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+
+def count(metrics, name, value):
+    if metrics is not None:
+        metrics.count(name, value)
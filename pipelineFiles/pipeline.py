@@ -0,0 +1,35 @@
+#! /usr/bin/env python3
+
+import os
+
+import classification
+import get_aln_regions
+from metrics import count, stage
+
+# MTase profiles used by hmmsearch and their region definitions used by region detection
+PROFILES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'selected_profiles.hmm')
+REGIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'All_profile_region.csv')
+
+# region definitions by (path, size, modification time)
+_regions = dict()
+
+# function for reading region definitions, unchanged files are not parsed again
+def default_regions(path=REGIONS_PATH):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _regions:
+        _regions[key] = get_aln_regions.read_regions(path)
+    return _regions[key]
+
+# function for running region detection and classification (pipline steps 2 and 3) in memory
+# returns region table, classified MTases and MTases with several catalytic domains
+# stage timings and row counts are added to metrics if given
+def run_pipeline(instk, regions=None, jobs=1, metrics=None):
+    if regions is None:
+        regions = default_regions()
+    with stage(metrics, 'region_detection'):
+        region_df = get_aln_regions.region_frame(instk, regions, jobs, typed=True)
+    count(metrics, 'hits', region_df['Hit_ID'].nunique())
+    count(metrics, 'region_rows', len(region_df))
+    class_df, several_df = classification.classify(region_df.copy(), metrics)
+    return region_df, class_df, several_df
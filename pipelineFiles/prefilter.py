@@ -0,0 +1,154 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+import re
+import tempfile
+
+import get_aln_regions
+from classification import read_region_table
+from pipeline import PROFILES_PATH, default_regions, run_pipeline
+from search import run_search
+from seqstore import read_fasta
+
+# region table with motif fragments of reference MTases, used to build the default index
+# made by the build command from all hits of file.stk
+MOTIFS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference_motifs.tsv')
+MOTIF_REGIONS = ['sam_motif', 'cat_motif']
+# length of motif words looked up in sequences
+KMER = 5
+# degenerate catalytic motif IV of amino-MTases ((D/N/S)PP(Y/F/W)) and of C5-MTases (PC),
+# so MTases with motifs missing in the reference table are kept too
+DEGENERATE_MOTIFS = ['[DNS]PP[YFW]', '[GS][FP]PC']
+
+
+# function for collecting motif words of length k from sam_motif and cat_motif fragments of region table
+# gaps are removed and insert states are uppercased, fragments shorter than k are used whole
+def motif_kmers(df, k=KMER):
+    kmers = set()
+    frags = df.loc[df['Region_name'].isin(MOTIF_REGIONS), 'Alignment_frags'].dropna()
+    for frag in frags:
+        motif = re.sub('[^A-Z]', '', str(frag).upper())
+        if len(motif) < k:
+            if motif:
+                kmers.add(motif)
+            continue
+        kmers.update(motif[i:i + k] for i in range(len(motif) - k + 1))
+    return kmers
+
+
+# function for compiling motif words and degenerate motifs into one regular expression, longest words first
+def motif_index(kmers, degenerate=DEGENERATE_MOTIFS):
+    if not kmers:
+        raise ValueError('no sam_motif or cat_motif fragments in the motif table')
+    return re.compile('|'.join(sorted(kmers, key=lambda kmer: (-len(kmer), kmer)) + list(degenerate)))
+
+
+# function for writing sam_motif and cat_motif rows of all hits of Stockholm alignments as motif table
+# returns number of written rows
+def build_motif_table(instk, output):
+    region_df = get_aln_regions.region_frame(instk, default_regions())
+    motif_df = region_df[region_df['Region_name'].isin(MOTIF_REGIONS)]
+    motif_df.to_csv(output, sep='\t', index=False)
+    return len(motif_df)
+
+
+# motif indexes by (path, size, modification time, k)
+_indexes = dict()
+
+# function for loading motif index from region table, unchanged tables are not read again
+def load_index(path=MOTIFS_PATH, k=KMER):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, k)
+    if key not in _indexes:
+        _indexes[key] = motif_index(motif_kmers(read_region_table(path), k))
+    return _indexes[key]
+
+
+# function for writing sequences with at least one motif candidate to output
+# returns numbers of read and kept sequences
+def prefilter_fasta(fasta, output, index):
+    n_seqs = 0
+    n_kept = 0
+    with open(fasta) as infile, open(output, 'w') as outfile:
+        for name, seq in read_fasta(infile):
+            n_seqs += 1
+            if index.search(seq.upper()):
+                n_kept += 1
+                outfile.write(f'>{name}\n{seq}\n')
+    return n_seqs, n_kept
+
+
+# function for comparing prefilter with the full search on reference sequences
+# full_stk is hmmsearch output of all sequences, hmmsearch is run if it is not given
+def recall_report(fasta, index, full_stk=None, cpus=None):
+    n_seqs = 0
+    kept = set()
+    with open(fasta) as infile:
+        for name, seq in read_fasta(infile):
+            n_seqs += 1
+            if index.search(seq.upper()):
+                kept.add(name)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if full_stk is None:
+            full_stk = os.path.join(tmpdir, 'full.stk')
+            run_search(PROFILES_PATH, fasta, full_stk, cpus)
+        if os.path.exists(full_stk):
+            with open(full_stk) as instk:
+                region_df, class_df, _several_df = run_pipeline(instk)
+        else:
+            region_df, class_df, _several_df = run_pipeline([])
+    with_hits = set(region_df['REBASE_name'])
+    classified = set(class_df['REBASE_name'])
+    missed = sorted(classified - kept)
+    lines = [f'sequences\t{n_seqs}',
+             f'kept_by_prefilter\t{len(kept)}\t{len(kept) / n_seqs if n_seqs else 0:.4f}']
+    for label, names in [('with_hits', with_hits), ('classified', classified)]:
+        found = len(names & kept)
+        lines.append(f'{label}\t{len(names)}\tkept\t{found}\trecall\t{found / len(names) if names else 1:.4f}')
+    lines.append('missed_classified\t' + ','.join(missed))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drop sequences without SAM-binding or catalytic motif candidates before hmmsearch.')
+    parser.add_argument('--motifs', default=MOTIFS_PATH, metavar='regions.tsv',
+                        help='region table with sam_motif and cat_motif fragments, default is %(default)s')
+    parser.add_argument('-k', type=int, default=KMER, metavar='N',
+                        help='length of motif words, default is %(default)s')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='write motif table of reference hmmsearch alignments')
+    build_parser.add_argument('stockholm', metavar='hmmsearch.stk')
+    build_parser.add_argument('--output', default=MOTIFS_PATH, metavar='motifs.tsv',
+                              help='default is %(default)s')
+    filter_parser = subparsers.add_parser('filter', help='write sequences with motif candidates')
+    filter_parser.add_argument('fasta', metavar='sequences.fasta')
+    filter_parser.add_argument('output', metavar='output.fasta')
+    recall_parser = subparsers.add_parser('recall', help='report recall against the full search')
+    recall_parser.add_argument('fasta', metavar='reference.fasta')
+    recall_parser.add_argument('--full-search', metavar='hmmsearch.stk',
+                               help='hmmsearch alignments of all reference sequences, searched if not given')
+    recall_parser.add_argument('--cpus', type=int, metavar='N',
+                               help='number of cores to use, default is all cores')
+    recall_parser.add_argument('-o', '--output', metavar='FILE', help='report file, default is stdout')
+    args = parser.parse_args()
+    if args.command == 'build':
+        with open(args.stockholm) as instk:
+            n_rows = build_motif_table(instk, args.output)
+        print(f'{n_rows} motif rows written to {args.output}')
+        return
+    index = load_index(args.motifs, args.k)
+    if args.command == 'filter':
+        n_seqs, n_kept = prefilter_fasta(args.fasta, args.output, index)
+        print(f'kept {n_kept} of {n_seqs} sequences')
+    else:
+        report = recall_report(args.fasta, index, args.full_search, args.cpus)
+        if args.output:
+            with open(args.output, 'w') as outfile:
+                outfile.write(report)
+        else:
+            print(report, end='')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import tempfile
+
+import get_aln_regions
+
+# hmmsearch thresholds of pipline step 1
+HMMSEARCH_OPTIONS = ['-E', '0.01', '--domE', '0.01', '--incE', '0.01', '--incdomE', '0.01']
+# smallest shard worth its own hmmsearch process, in residues
+MIN_SHARD_RESIDUES = 5000000
+# hmmsearch threads per shard, HMMER threading does not scale well beyond a few cores
+CPUS_PER_SHARD = 2
+
+# function for counting sequences and residues in fasta file
+def fasta_size(fasta):
+    n_seqs = 0
+    n_residues = 0
+    with open(fasta) as infile:
+        for line in infile:
+            if line.startswith('>'):
+                n_seqs += 1
+            else:
+                n_residues += len(line.strip())
+    return n_seqs, n_residues
+
+# function for choosing number of shards and hmmsearch threads per shard
+# shards=0 chooses the number of shards by input size and cpu count
+def plan_shards(n_seqs, n_residues, cpus=None, shards=1):
+    cpus = cpus or os.cpu_count() or 1
+    if not shards:
+        shards = min(n_residues // MIN_SHARD_RESIDUES, cpus // CPUS_PER_SHARD)
+    shards = max(1, min(shards, n_seqs))
+    return shards, max(1, cpus // shards)
+
+# function for splitting fasta file into shards, sequences are dealt round-robin
+def split_fasta(fasta, shard_paths):
+    shard_files = [open(path, 'w') for path in shard_paths]
+    try:
+        outfile = shard_files[0]
+        n_seqs = 0
+        with open(fasta) as infile:
+            for line in infile:
+                if line.startswith('>'):
+                    outfile = shard_files[n_seqs % len(shard_files)]
+                    n_seqs += 1
+                outfile.write(line)
+    finally:
+        for outfile in shard_files:
+            outfile.close()
+
+# function for reading profile names in the order of the HMM file
+def profile_names(profiles):
+    with open(profiles) as infile:
+        return [line.split()[1] for line in infile if line.startswith('NAME ')]
+
+# function for merging Stockholm alignments of shards into one block per profile
+# column annotation (#=GC) is dropped as insert columns differ between shards
+def merge_alignments(shard_stks, output, order=()):
+    blocks = dict()
+    for path in shard_stks:
+        with open(path) as instk:
+            for block in get_aln_regions.iter_blocks(instk):
+                hmmid = None
+                gf_lines, gs_lines, seq_lines = [], [], []
+                for line in block:
+                    if line.startswith('#=GF'):
+                        gf_lines.append(line)
+                        if line.startswith('#=GF ID'):
+                            hmmid = line[8:].strip()
+                    elif line.startswith('#=GS'):
+                        gs_lines.append(line)
+                    elif line.startswith('#=GR') or line.strip() and not line.startswith(('#', '//')):
+                        seq_lines.append(line)
+                merged = blocks.setdefault(hmmid, [gf_lines, [], []])
+                merged[1].extend(gs_lines)
+                merged[2].extend(seq_lines)
+    order = [hmmid for hmmid in order if hmmid in blocks]
+    order += [hmmid for hmmid in blocks if hmmid not in order]
+    with open(output, 'w') as outstk:
+        for hmmid in order:
+            gf_lines, gs_lines, seq_lines = blocks[hmmid]
+            outstk.write('# STOCKHOLM 1.0\n')
+            outstk.writelines(gf_lines)
+            outstk.write('\n')
+            outstk.writelines(gs_lines)
+            outstk.write('\n')
+            outstk.writelines(seq_lines)
+            outstk.write('//\n')
+
+# function for starting hmmsearch writing alignments of hits to output
+def start_hmmsearch(profiles, fasta, output, cpu, size_options):
+    return subprocess.Popen(['hmmsearch', '--cpu', str(cpu), *HMMSEARCH_OPTIONS, *size_options,
+                             '-o', os.devnull, '--noali', '-A', output, profiles, fasta])
+
+# function for running hmmsearch on fasta shards concurrently - pipline step 1
+# z and domz fix database sizes used for E-values, by default z is the number of sequences
+# and domain E-values depend on the number of significant sequences in each shard,
+# so without domz results are the same as of unsharded hmmsearch only with shards=1 (the default);
+# with shards=0 the number of shards depends on the cpu count of the host
+def run_search(profiles, fasta, output, cpus=None, z=None, domz=None, shards=1):
+    n_seqs, n_residues = fasta_size(fasta)
+    if not n_seqs:
+        # hmmsearch rejects -Z 0, without sequences there are no hits and no alignments are written
+        return
+    shards, cpu = plan_shards(n_seqs, n_residues, cpus, shards)
+    # -Z keeps E-values of every shard relative to the whole input
+    size_options = ['-Z', str(z or n_seqs)] + (['--domZ', str(domz)] if domz else [])
+    if shards == 1:
+        process = start_hmmsearch(profiles, fasta, output, cpu, size_options)
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_fastas = [os.path.join(tmpdir, f'shard{i}.fasta') for i in range(shards)]
+        shard_stks = [os.path.join(tmpdir, f'shard{i}.stk') for i in range(shards)]
+        split_fasta(fasta, shard_fastas)
+        processes = [start_hmmsearch(profiles, shard_fasta, shard_stk, cpu, size_options)
+                     for shard_fasta, shard_stk in zip(shard_fastas, shard_stks)]
+        for process in processes:
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        # shards without hits do not write alignment files
+        merge_alignments([path for path in shard_stks if os.path.exists(path)], output,
+                         profile_names(profiles))
+
+def main():
+    parser = argparse.ArgumentParser(description='Search MTase profiles in sequences with sharded hmmsearch.')
+    parser.add_argument('profiles', metavar='profiles.hmm')
+    parser.add_argument('fasta', metavar='sequences.fasta')
+    parser.add_argument('output', metavar='output.stk')
+    parser.add_argument('--cpus', type=int, metavar='N',
+                        help='number of cores to use, default is all cores')
+    parser.add_argument('--shards', type=int, default=1, metavar='N',
+                        help='run N hmmsearch processes on parts of the input, 0 chooses N by input size '
+                             'and cores; domain E-values then depend on N unless --domZ is given')
+    parser.add_argument('--domZ', type=float, metavar='N',
+                        help='database size of domain E-values, default is the number of significant sequences')
+    args = parser.parse_args()
+    run_search(args.profiles, args.fasta, args.output, args.cpus, domz=args.domZ, shards=args.shards)
+
+if __name__ == '__main__':
+    main()
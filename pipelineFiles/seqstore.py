@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+import get_aln_regions
+from cache import file_digest
+from pipeline import PROFILES_PATH
+from search import profile_names, run_search
+
+# persistent store of hmmsearch hits of every searched sequence
+STORE_PATH = os.environ.get('MTASE_SEQUENCE_STORE',
+                            os.path.join(os.path.expanduser('~'), '.cache', 'mtase-pipeline', 'sequences.db'))
+# fixed database sizes for E-values, so hits of a sequence do not depend on the other uploaded sequences
+# results differ from a plain search, where -Z is the number of uploaded sequences and domain E-values
+# depend on the number of significant sequences, so incremental search is only used when asked for
+SEARCH_Z = 5000
+SEARCH_DOMZ = 10
+
+
+# function for reading fasta as (name, sequence) pairs, the name is the first word of the header as in hmmsearch
+def read_fasta(lines):
+    name = None
+    seq = []
+    for line in lines:
+        if line.startswith('>'):
+            if name is not None:
+                yield name, ''.join(seq)
+            name = line[1:].split(maxsplit=1)[0] if line[1:].strip() else ''
+            seq = []
+        else:
+            seq.append(line.strip())
+    if name is not None:
+        yield name, ''.join(seq)
+
+
+# function for calculating digest of a sequence, the same for any line wrapping and letter case
+def sequence_digest(seq):
+    return hashlib.sha256(seq.upper().encode()).hexdigest()
+
+
+class SequenceStore:
+    """SQLite store of hmmsearch hits keyed by sequence digest.
+
+    Hits are kept separately for every profile file and E-value setting,
+    and sequences without hits are remembered too, so they are never
+    searched again. Region rows are cut from the stored hits, so editing
+    region definitions does not require a new search.
+    """
+
+    def __init__(self, path=STORE_PATH, profiles=PROFILES_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.search_key = hashlib.sha256(
+            f'{file_digest(profiles)} Z={SEARCH_Z} domZ={SEARCH_DOMZ}'.encode()).hexdigest()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS searched '
+                               '(digest TEXT, search_key TEXT, PRIMARY KEY (digest, search_key))')
+            connection.execute('CREATE TABLE IF NOT EXISTS hits '
+                               '(digest TEXT, search_key TEXT, hmmid TEXT, coords TEXT, aln TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS hits_digest ON hits (digest, search_key)')
+
+    @contextmanager
+    def _connect(self):
+        # a connection per call, so the store can be used from job threads
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def missing(self, digests):
+        """Return digests of sequences that were not searched yet."""
+        digests = set(digests)
+        with self._connect() as connection:
+            connection.execute('CREATE TEMP TABLE query (digest TEXT PRIMARY KEY)')
+            connection.executemany('INSERT INTO query VALUES (?)', ((d,) for d in digests))
+            found = connection.execute(
+                'SELECT digest FROM searched JOIN query USING (digest) WHERE search_key = ?',
+                (self.search_key,))
+            return digests - {digest for digest, in found}
+
+    def add(self, digests, hits):
+        """Store hits, (digest, hmmid, coords, aln) tuples, and mark digests as searched.
+
+        Hits are stored only for digests marked in the same transaction, so a
+        sequence searched by two jobs at once keeps the hits of one of them.
+        """
+        with self._connect() as connection:
+            new = set()
+            for digest in digests:
+                if connection.execute('INSERT OR IGNORE INTO searched VALUES (?, ?)',
+                                      (digest, self.search_key)).rowcount:
+                    new.add(digest)
+            connection.executemany('INSERT INTO hits VALUES (?, ?, ?, ?, ?)',
+                                   ((d, self.search_key, hmmid, coords, aln)
+                                    for d, hmmid, coords, aln in hits if d in new))
+
+    def hits(self, digests):
+        """Return dict of digest -> list of (hmmid, coords, aln) hits."""
+        result = {digest: [] for digest in digests}
+        with self._connect() as connection:
+            connection.execute('CREATE TEMP TABLE query (digest TEXT PRIMARY KEY)')
+            connection.executemany('INSERT INTO query VALUES (?)', ((d,) for d in result))
+            # stores written before hits were added once per sequence may hold duplicates
+            rows = connection.execute(
+                'SELECT digest, hmmid, coords, aln FROM hits JOIN query USING (digest) '
+                'WHERE search_key = ? GROUP BY digest, hmmid, coords, aln ORDER BY MIN(hits.rowid)',
+                (self.search_key,))
+            for digest, hmmid, coords, aln in rows:
+                result[digest].append((hmmid, coords, aln))
+        return result
+
+
+# function for writing (hmmid, seqid, aln) records as Stockholm alignments, one block per profile
+def write_stockholm(records, outstk, order=()):
+    blocks = dict()
+    for hmmid, seqid, aln in records:
+        blocks.setdefault(hmmid, []).append((seqid, aln))
+    order = [hmmid for hmmid in order if hmmid in blocks]
+    order += [hmmid for hmmid in blocks if hmmid not in order]
+    for hmmid in order:
+        outstk.write(f'# STOCKHOLM 1.0\n#=GF ID {hmmid}\n\n')
+        for seqid, aln in blocks[hmmid]:
+            outstk.write(f'{seqid} {aln}\n')
+        outstk.write('//\n')
+
+
+# function for searching only sequences missing in the store - incremental pipline step 1
+# writes Stockholm alignments of stored and new hits of all sequences to output
+# returns numbers of sequences and of searched new sequences
+def incremental_search(fasta, output, profiles=PROFILES_PATH, store_path=STORE_PATH, cpus=None):
+    store = SequenceStore(store_path, profiles)
+    with open(fasta) as infile:
+        sequences = [(name, sequence_digest(seq)) for name, seq in read_fasta(infile)]
+    missing = store.missing(digest for _name, digest in sequences)
+    searched = set()
+    if missing:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            new_fasta = os.path.join(tmpdir, 'new.fasta')
+            new_stk = os.path.join(tmpdir, 'new.stk')
+            # new sequences are searched under their digests, once for every distinct sequence
+            with open(fasta) as infile, open(new_fasta, 'w') as outfile:
+                for _name, seq in read_fasta(infile):
+                    digest = sequence_digest(seq)
+                    if digest in missing:
+                        missing.discard(digest)
+                        searched.add(digest)
+                        outfile.write(f'>{digest}\n{seq}\n')
+            # with both database sizes fixed E-values do not depend on sharding
+            run_search(profiles, new_fasta, new_stk, cpus, SEARCH_Z, SEARCH_DOMZ, shards=0)
+            hits = []
+            # hmmsearch does not write alignments if nothing was found
+            if os.path.exists(new_stk):
+                with open(new_stk) as instk:
+                    for hmmid, seqid, aln in get_aln_regions.read_stockholm(instk):
+                        digest, coords = seqid.split('/', 1)
+                        hits.append((digest, hmmid, coords, aln))
+            store.add(searched, hits)
+    stored = store.hits(digest for _name, digest in sequences)
+    records = ((hmmid, f'{name}/{coords}', aln)
+               for name, digest in sequences for hmmid, coords, aln in stored[digest])
+    with open(output, 'w') as outstk:
+        write_stockholm(records, outstk, profile_names(profiles))
+    return len(sequences), len(searched)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Search MTase profiles only in sequences that are not in the sequence store.')
+    parser.add_argument('fasta', metavar='sequences.fasta')
+    parser.add_argument('output', metavar='output.stk')
+    parser.add_argument('--profiles', default=PROFILES_PATH, metavar='profiles.hmm')
+    parser.add_argument('--store', default=STORE_PATH, metavar='sequences.db')
+    parser.add_argument('--cpus', type=int, metavar='N',
+                        help='number of cores to use, default is all cores')
+    args = parser.parse_args()
+    incremental_search(args.fasta, args.output, args.profiles, args.store, args.cpus)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+
+import argparse
+import os
+import sys
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+# directory of the service socket and key, private to the user running the service
+SERVICE_DIR = os.environ.get('MTASE_SERVICE_DIR',
+                             os.path.join(os.environ['XDG_RUNTIME_DIR'], 'mtase-pipeline')
+                             if os.environ.get('XDG_RUNTIME_DIR') else
+                             os.path.join(os.path.expanduser('~'), '.cache', 'mtase-pipeline'))
+# local socket of the search service
+SOCKET_PATH = os.environ.get('MTASE_SERVICE_SOCKET', os.path.join(SERVICE_DIR, 'service.sock'))
+# key clients prove they know before the service reads their requests, requests are unpickled
+AUTHKEY_PATH = os.environ.get('MTASE_SERVICE_AUTHKEY', os.path.join(SERVICE_DIR, 'service.key'))
+
+
+# function for making directory readable only by the user, existing directories are made private too
+def private_dir(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+
+
+# function for reading the service key, a random key is made on first use
+def read_authkey(path=AUTHKEY_PATH):
+    private_dir(os.path.dirname(os.path.abspath(path)))
+    try:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as infile:
+            return infile.read()
+    authkey = os.urandom(32)
+    with os.fdopen(descriptor, 'wb') as outfile:
+        outfile.write(authkey)
+    return authkey
+
+
+# function for loading everything a job needs once, so the first query is as fast as the next ones
+# pipeline modules are imported here, clients only need the standard library
+def warm_up():
+    import cache, jobs, prefilter # pylint: disable=import-outside-toplevel,multiple-imports,unused-import
+    from pipeline import PROFILES_PATH, REGIONS_PATH, default_regions # pylint: disable=import-outside-toplevel
+    default_regions()
+    prefilter.load_index()
+    cache.file_digest(PROFILES_PATH)
+    cache.file_digest(REGIONS_PATH)
+
+
+# function for answering one client: request is (fasta bytes, prefilter flag, incremental search flag)
+# reply is ('finished', cached, (regions, class, several cat-domain tables as TSV text)) or ('failed', error message)
+def _handle(connection):
+    import jobs # pylint: disable=import-outside-toplevel
+    with connection:
+        try:
+            fasta, use_prefilter, use_incremental = connection.recv()
+            job = jobs.submit_job(fasta, use_prefilter, use_incremental)
+            job.future.result()
+            if job.status == 'finished':
+                region_df, class_df, several_df = job.result
+                tables = (region_df.to_csv(sep='\t', index=False), class_df.to_csv(sep='\t'),
+                          several_df.to_csv(sep='\t'))
+                connection.send(('finished', job.cached, tables))
+            else:
+                connection.send(('failed', str(job.error)))
+        except (EOFError, OSError):
+            # client has gone
+            pass
+        except Exception as error: # pylint: disable=broad-except
+            connection.send(('failed', str(error)))
+
+
+# function for serving pipeline jobs on local socket until interrupted
+# jobs run in this long-lived process, so modules, regions and file digests stay loaded
+def serve(address=SOCKET_PATH, authkey_path=AUTHKEY_PATH):
+    warm_up()
+    authkey = read_authkey(authkey_path)
+    private_dir(os.path.dirname(os.path.abspath(address)))
+    if os.path.exists(address):
+        # socket left by a stopped service
+        os.unlink(address)
+    with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+        os.chmod(address, 0o600)
+        print(f'serving on {address}', file=sys.stderr)
+        try:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError):
+                    # client without the key
+                    continue
+                threading.Thread(target=_handle, args=(connection,), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+
+
+# function for running pipeline on fasta bytes in the service
+# returns region, class and several cat-domain tables as TSV text and whether they were cached
+def query(fasta, use_prefilter=False, address=SOCKET_PATH, use_incremental=False, authkey_path=AUTHKEY_PATH):
+    with Client(address, family='AF_UNIX', authkey=read_authkey(authkey_path)) as connection:
+        connection.send((fasta, use_prefilter, use_incremental))
+        reply = connection.recv()
+    if reply[0] != 'finished':
+        raise RuntimeError(reply[1])
+    return reply[2], reply[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm MTase pipeline service on a local socket.')
+    parser.add_argument('--socket', default=SOCKET_PATH, metavar='PATH',
+                        help='socket of the service, default is %(default)s')
+    parser.add_argument('--authkey', default=AUTHKEY_PATH, metavar='PATH',
+                        help='file of the key shared by the service and its clients, default is %(default)s')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help='start the service')
+    query_parser = subparsers.add_parser('query', help='classify sequences with the running service')
+    query_parser.add_argument('fasta', metavar='sequences.fasta')
+    query_parser.add_argument('--prefilter', action='store_true',
+                              help='search only sequences with motif candidates')
+    query_parser.add_argument('--incremental', action='store_true',
+                              help='search only sequences not searched before, with fixed E-value database sizes')
+    query_parser.add_argument('--region-output', metavar='regions.tsv')
+    query_parser.add_argument('--class-output', metavar='class.tsv', help='default is stdout')
+    query_parser.add_argument('--more-than-one-cat-domain', metavar='several_cat_domains.tsv')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.socket, args.authkey)
+        return
+    with open(args.fasta, 'rb') as infile:
+        (regions, classes, several), _cached = query(infile.read(), args.prefilter, args.socket, args.incremental,
+                                                  args.authkey)
+    for path, table in [(args.region_output, regions), (args.more_than_one_cat_domain, several)]:
+        if path:
+            with open(path, 'w') as outfile:
+                outfile.write(table)
+    if args.class_output:
+        with open(args.class_output, 'w') as outfile:
+            outfile.write(classes)
+    else:
+        sys.stdout.write(classes)
+
+if __name__ == '__main__':
+    main()
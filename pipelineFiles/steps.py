@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import classification
+import get_aln_regions
+import prefilter
+import search
+import seqstore
+from cache import file_digest
+from metrics import Metrics, count, stage
+from pipeline import PROFILES_PATH, REGIONS_PATH
+from seqstore import SEARCH_DOMZ, SEARCH_Z, STORE_PATH, incremental_search
+
+# pipeline step: input files and parameters it depends on, output files it writes
+# and function running it; code files of the step are inputs too, so editing
+# region detection or classification code (e.g. filter thresholds) reruns that step
+Step = namedtuple('Step', ['name', 'inputs', 'params', 'outputs', 'run'])
+
+STATE_FILE = 'steps.json'
+
+
+# function for searching profiles - pipline step 1
+# with use_incremental only sequences new to the sequence store are searched, with fixed E-value database sizes
+def run_search(fasta, stk, profiles, use_prefilter, use_incremental, store_path, cpus, metrics=None):
+    if use_prefilter:
+        kept_fasta = stk + '.kept.fasta'
+        n_seqs, n_kept = prefilter.prefilter_fasta(fasta, kept_fasta, prefilter.load_index())
+        count(metrics, 'sequences', n_seqs)
+        count(metrics, 'sequences_after_prefilter', n_kept)
+        fasta = kept_fasta
+    try:
+        if use_incremental:
+            n_seqs, n_searched = incremental_search(fasta, stk, profiles, store_path, cpus)
+        else:
+            n_seqs, _n_residues = search.fasta_size(fasta)
+            n_searched = n_seqs
+            search.run_search(profiles, fasta, stk, cpus)
+            # hmmsearch does not write alignments if nothing was found
+            if not os.path.exists(stk):
+                open(stk, 'w').close()
+    finally:
+        if use_prefilter:
+            os.remove(fasta)
+    if not use_prefilter:
+        count(metrics, 'sequences', n_seqs)
+    count(metrics, 'sequences_searched', n_searched)
+
+
+# function for region detection - pipline step 2
+def run_extraction(stk, regions_path, region_table, metrics=None):
+    regions = get_aln_regions.read_regions(regions_path)
+    with open(stk) as instk, open(region_table, 'w') as outfile:
+        outsv = get_aln_regions.etsv.ETSVWriter(outfile, get_aln_regions.REGION_FIELDS)
+        n_hits, n_rows = get_aln_regions.process_alignments(instk, outsv, regions)
+    count(metrics, 'hits', n_hits)
+    count(metrics, 'region_rows', n_rows)
+
+
+# function for classification - pipline step 3
+def run_classification(region_table, class_output, several_output, metrics=None):
+    df, several_cat_domains = classification.classify(classification.read_region_table(region_table), metrics)
+    several_cat_domains.to_csv(several_output, sep='\t')
+    df.to_csv(class_output, sep='\t')
+
+
+# function for declaring pipline steps on fasta with all artifacts written to workdir
+def pipeline_steps(fasta, workdir, profiles=PROFILES_PATH, regions=REGIONS_PATH, use_prefilter=False,
+                   use_incremental=False, store_path=STORE_PATH, cpus=None, metrics=None):
+    stk = os.path.join(workdir, 'file.stk')
+    region_table = os.path.join(workdir, 'regions.tsv')
+    class_output = os.path.join(workdir, 'class.tsv')
+    several_output = os.path.join(workdir, 'several_cat_domains.tsv')
+    search_code = [search.__file__] + ([seqstore.__file__] if use_incremental else [])
+    search_params = ('-Z', SEARCH_Z, '--domZ', SEARCH_DOMZ) if use_incremental else ()
+    if use_prefilter:
+        search_code += [prefilter.__file__, prefilter.MOTIFS_PATH]
+    return [
+        Step('search', [fasta, profiles] + search_code,
+             search_params + (('prefilter', prefilter.KMER) if use_prefilter else ('',)),
+             [stk], lambda: run_search(fasta, stk, profiles, use_prefilter, use_incremental, store_path, cpus,
+                                       metrics)),
+        Step('extraction', [stk, regions, get_aln_regions.__file__, get_aln_regions.etsv.main.__file__], (),
+             [region_table], lambda: run_extraction(stk, regions, region_table, metrics)),
+        Step('classification', [region_table, classification.__file__], (),
+             [class_output, several_output],
+             lambda: run_classification(region_table, class_output, several_output, metrics)),
+    ]
+
+
+# function for fingerprinting a step by contents of its inputs and its parameters
+def step_fingerprint(step):
+    digest = hashlib.sha256(step.name.encode())
+    for path in step.inputs:
+        digest.update(file_digest(path).encode())
+    digest.update(repr(step.params).encode())
+    return digest.hexdigest()
+
+
+def read_state(path):
+    try:
+        with open(path) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return dict()
+
+
+def write_state(state, path):
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(state, outfile, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+# function for checking that outputs of the step were made from the same inputs and were not changed since
+def is_up_to_date(step, fingerprint, record):
+    if record is None or record['fingerprint'] != fingerprint:
+        return False
+    for path in step.outputs:
+        name = os.path.basename(path)
+        if not os.path.exists(path) or record['outputs'].get(name) != file_digest(path):
+            return False
+    return True
+
+
+# function for running steps in order, steps with unchanged inputs and outputs are skipped
+# later steps depend on outputs of earlier ones, so they run again only if those outputs changed
+# returns list of (step name, 'ran' or 'up to date')
+def run_steps(steps, state_path, force=(), metrics=None):
+    state = read_state(state_path)
+    report = []
+    for step in steps:
+        fingerprint = step_fingerprint(step)
+        if step.name not in force and is_up_to_date(step, fingerprint, state.get(step.name)):
+            report.append((step.name, 'up to date'))
+            continue
+        # a failed step must not look up to date on the next run
+        state.pop(step.name, None)
+        write_state(state, state_path)
+        with stage(metrics, step.name):
+            step.run()
+        state[step.name] = dict(fingerprint=fingerprint,
+                                outputs={os.path.basename(path): file_digest(path) for path in step.outputs})
+        write_state(state, state_path)
+        report.append((step.name, 'ran'))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run MTase pipeline steps in a work directory, only steps whose inputs changed are run again.')
+    parser.add_argument('fasta', metavar='sequences.fasta')
+    parser.add_argument('workdir', help='directory of file.stk, regions.tsv, class.tsv, '
+                                        'several_cat_domains.tsv and step state')
+    parser.add_argument('--profiles', default=PROFILES_PATH, metavar='profiles.hmm')
+    parser.add_argument('--regions', default=REGIONS_PATH, metavar='All_profile_region.csv')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='search only sequences with motif candidates')
+    parser.add_argument('--incremental', action='store_true',
+                        help='search only sequences not in the sequence store, E-values use fixed database sizes')
+    parser.add_argument('--store', default=STORE_PATH, metavar='sequences.db')
+    parser.add_argument('--cpus', type=int, metavar='N',
+                        help='number of cores to use, default is all cores')
+    parser.add_argument('--force', action='append', default=[], choices=['search', 'extraction', 'classification'],
+                        help='run the step even if it is up to date, can be repeated')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write stage timings, peak memory and row counts as JSON')
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    metrics = Metrics()
+    steps = pipeline_steps(args.fasta, args.workdir, args.profiles, args.regions, args.prefilter,
+                           args.incremental, args.store, args.cpus, metrics)
+    for name, status in run_steps(steps, os.path.join(args.workdir, STATE_FILE), args.force, metrics):
+        print(f'{name}: {status}')
+    metrics.finish()
+    if args.metrics:
+        metrics.write(args.metrics)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import os
+import struct
+import tempfile
+import zlib
+from collections import namedtuple
+
+# alignment block of one profile: offset and length of the block text,
+# offsets of the lines of every sequence in the block
+Block = namedtuple("Block", ["hmmid", "offset", "length", "seqs"])
+
+INDEX_SUFFIX = ".idx"
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+def is_bgzf(path):
+    """Tell whether a file is BGZF (blocked gzip, as written by bgzip)."""
+    with open(path, "rb") as infile:
+        header = infile.read(18)
+    return header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def _bgzf_blocks(raw):
+    """Yield (compressed offset, uncompressed data) of BGZF blocks."""
+    while True:
+        coffset = raw.tell()
+        header = raw.read(12)
+        if not header:
+            return
+        if header[:4] != BGZF_MAGIC:
+            raise ValueError(f"not a BGZF block at offset {coffset}")
+        xlen, = struct.unpack("<H", header[10:12])
+        extra = raw.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen, = struct.unpack("<H", extra[i+2:i+4])
+            if extra[i:i+2] == b"BC":
+                bsize, = struct.unpack("<H", extra[i+4:i+6])
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError(f"not a BGZF block at offset {coffset}")
+        cdata = raw.read(bsize - xlen - 19)
+        raw.read(8) # CRC32 and ISIZE
+        yield coffset, zlib.decompress(cdata, -15)
+
+
+def iter_line_offsets(path):
+    """Yield (offset, line) pairs of a plain or BGZF file, lines as bytes.
+
+    Offsets of BGZF files are virtual offsets, the compressed offset of
+    the block shifted by 16 bits plus the offset inside the block.
+    """
+    if not is_bgzf(path):
+        offset = 0
+        with open(path, "rb") as infile:
+            for line in infile:
+                yield offset, line
+                offset += len(line)
+        return
+    with open(path, "rb") as raw:
+        pending = []
+        pending_offset = None
+        for coffset, data in _bgzf_blocks(raw):
+            start = 0
+            while start < len(data):
+                if not pending:
+                    pending_offset = coffset << 16 | start
+                end = data.find(b"\n", start) + 1
+                if not end:
+                    # line continues in the next block
+                    pending.append(data[start:])
+                    break
+                pending.append(data[start:end])
+                yield pending_offset, b"".join(pending)
+                pending = []
+                start = end
+        if pending:
+            yield pending_offset, b"".join(pending)
+
+
+def build_index(path):
+    """Return list of Blocks of a Stockholm file."""
+    blocks = []
+    hmmid = None
+    block_offset = None
+    length = 0
+    seqs = dict()
+    for offset, line in iter_line_offsets(path):
+        if block_offset is None:
+            block_offset = offset
+        length += len(line)
+        tag = line[:2]
+        if tag == b"#=":
+            if line[:7] == b"#=GF ID":
+                hmmid = line[8:].strip().decode()
+        elif tag == b"//":
+            blocks.append(Block(hmmid, block_offset, length, seqs))
+            hmmid = None
+            block_offset = None
+            length = 0
+            seqs = dict()
+        elif tag[:1] != b"#" and line.strip():
+            seqid = line.split(None, 1)[0].decode()
+            seqs.setdefault(seqid, []).append(offset)
+    return blocks
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}\t{stat.st_mtime_ns}"
+
+
+def write_index(blocks, path, outfile):
+    """Write index as text: a stamp of the indexed file, then B lines of
+    blocks each followed by S lines of its sequences."""
+    outfile.write(f"#:stkindex\t{_file_stamp(path)}\n")
+    for block in blocks:
+        outfile.write(f"B\t{block.hmmid}\t{block.offset}\t{block.length}\n")
+        for seqid, offsets in block.seqs.items():
+            outfile.write(f"S\t{seqid}\t{','.join(map(str, offsets))}\n")
+
+
+def read_index(inidx):
+    blocks = []
+    for line in inidx:
+        fields = line.rstrip("\n").split("\t")
+        if fields[0] == "B":
+            blocks.append(Block(fields[1], int(fields[2]), int(fields[3]), dict()))
+        elif fields[0] == "S":
+            blocks[-1].seqs[fields[1]] = [int(n) for n in fields[2].split(",")]
+    return blocks
+
+
+def load_index(path):
+    """Return Blocks of a Stockholm file from its sidecar index.
+
+    The index is built and written next to the file if it is missing or
+    was built for another version of the file. If the directory is not
+    writable, the index is only kept in memory.
+    """
+    idx_path = path + INDEX_SUFFIX
+    try:
+        with open(idx_path) as inidx:
+            if inidx.readline() == f"#:stkindex\t{_file_stamp(path)}\n":
+                return read_index(inidx)
+    except FileNotFoundError:
+        pass
+    blocks = build_index(path)
+    # readers never see a half written index, also when several processes build it at once
+    try:
+        descriptor, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(idx_path)),
+            prefix=os.path.basename(idx_path) + ".", suffix=".tmp")
+    except OSError:
+        return blocks
+    try:
+        with os.fdopen(descriptor, "w") as outidx:
+            write_index(blocks, path, outidx)
+        os.replace(tmp_path, idx_path)
+    except OSError:
+        os.unlink(tmp_path)
+    return blocks
+
+
+def _open_at(path, offset):
+    """Open file for binary reading at a plain or BGZF virtual offset."""
+    raw = open(path, "rb")
+    if not is_bgzf(path):
+        raw.seek(offset)
+        return raw
+    raw.seek(offset >> 16)
+    infile = gzip.GzipFile(fileobj=raw)
+    infile.read(offset & 0xFFFF)
+    # closing the gzip reader does not close the underlying file
+    infile.myfileobj = raw
+    return infile
+
+
+def read_block(path, offset, length):
+    """Return lines of the block at offset as strings."""
+    with _open_at(path, offset) as infile:
+        return infile.read(length).decode().splitlines(keepends=True)
+
+
+def read_seq_lines(path, offsets):
+    """Return sequence lines at the offsets as strings."""
+    lines = []
+    for offset in offsets:
+        with _open_at(path, offset) as infile:
+            lines.append(infile.readline().decode())
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build byte-offset index of Stockholm alignment blocks.")
+    parser.add_argument("stockholm", metavar="hmmsearch.stk[.gz]",
+                        help="plain or BGZF compressed (bgzip) Stockholm file")
+    args = parser.parse_args()
+    if args.stockholm.endswith(".gz") and not is_bgzf(args.stockholm):
+        parser.error("gzip file is not BGZF, recompress it with bgzip")
+    index = load_index(args.stockholm)
+    print(f"{len(index)} blocks, {sum(len(block.seqs) for block in index)} "
+          f"hits indexed in {args.stockholm}{INDEX_SUFFIX}")
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+import argparse
+import gzip
+import hashlib
+import os
+import sys
+import threading
+import urllib.request
+from collections import OrderedDict
+
+import pandas as pd
+
+from cache import file_digest
+
+# directory of PDB and mmCIF files named by PDB code, e.g. 2OKC.cif or 2okc.pdb.gz
+STRUCTURES_DIR = os.environ.get('MTASE_STRUCTURES_DIR',
+                                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'structures'))
+# size limit of structures kept in memory
+MAX_STRUCTURE_BYTES = int(os.environ.get('MTASE_STRUCTURE_CACHE_BYTES', 2**28))
+TABLE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'class_withStructure.tsv')
+DOWNLOAD_URL = 'https://files.rcsb.org/download/{code}.cif'
+
+# py3Dmol formats of file suffixes
+FORMATS = {'.pdb': 'pdb', '.ent': 'pdb', '.cif': 'cif', '.mmcif': 'cif'}
+
+# structure indexes by (directory, modification time)
+_indexes = dict()
+# structure text and format by (code or upload, file digest), least recently used first
+# the cache is shared by threads of all page sessions
+_structures = OrderedDict()
+_structures_bytes = 0
+_structures_lock = threading.Lock()
+
+
+# function for splitting structure file name to upper case PDB code and py3Dmol format, None if not a structure
+def parse_name(name):
+    base = name[:-3] if name.endswith('.gz') else name
+    code, suffix = os.path.splitext(base)
+    fmt = FORMATS.get(suffix.lower())
+    return (code.upper(), fmt) if fmt else None
+
+
+# function for indexing structure files of the directory by PDB code, unchanged directory is not listed again
+def structure_index(directory=STRUCTURES_DIR):
+    try:
+        key = (os.path.abspath(directory), os.stat(directory).st_mtime_ns)
+    except FileNotFoundError:
+        return dict()
+    if key not in _indexes:
+        index = dict()
+        for name in sorted(os.listdir(directory)):
+            parsed = parse_name(name)
+            if parsed:
+                index.setdefault(parsed[0], (os.path.join(directory, name), parsed[1]))
+        _indexes[key] = index
+    return _indexes[key]
+
+
+# function for reading PDB codes of MTases with structures from class table
+def table_codes(path=TABLE_PATH):
+    codes = pd.read_csv(path, sep='\t')['Repr. PDB code'].dropna()
+    return sorted({code.strip().upper() for code in codes if code.strip()})
+
+
+# function for adding structure text to the cache, least recently used structures are dropped over the limit
+def _remember(key, structure):
+    global _structures_bytes # pylint: disable=global-statement
+    with _structures_lock:
+        if key in _structures:
+            # loaded by another session at the same time
+            return
+        _structures[key] = structure
+        _structures_bytes += len(structure[0])
+        while _structures_bytes > MAX_STRUCTURE_BYTES and len(_structures) > 1:
+            _key, (text, _fmt) = _structures.popitem(last=False)
+            _structures_bytes -= len(text)
+
+
+def _recall(key):
+    with _structures_lock:
+        structure = _structures.get(key)
+        if structure is not None:
+            _structures.move_to_end(key)
+        return structure
+
+
+# function for loading structure of PDB code from the local store
+# returns (text, py3Dmol format) or None if the store has no file of the code
+def load_structure(code, directory=STRUCTURES_DIR):
+    entry = structure_index(directory).get(code.strip().upper())
+    if entry is None:
+        return None
+    path, fmt = entry
+    key = (code.strip().upper(), file_digest(path))
+    structure = _recall(key)
+    if structure is None:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as infile:
+            structure = (infile.read(), fmt)
+        _remember(key, structure)
+    return structure
+
+
+# function for loading uploaded structure file, returns (text, py3Dmol format)
+# the same upload is decoded once, format is taken from the file name as stmol does
+def uploaded_structure(data, name):
+    key = (name, hashlib.sha256(data).hexdigest())
+    structure = _recall(key)
+    if structure is None:
+        parsed = parse_name(name)
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        structure = (data.decode(), parsed[1] if parsed else 'pdb')
+        _remember(key, structure)
+    return structure
+
+
+# function for downloading missing structures of the codes into the store, needs network access
+# returns codes which could not be downloaded
+def fetch_structures(codes, directory=STRUCTURES_DIR, url=DOWNLOAD_URL):
+    os.makedirs(directory, exist_ok=True)
+    index = structure_index(directory)
+    failed = []
+    for code in codes:
+        if code in index:
+            continue
+        path = os.path.join(directory, f'{code}.cif')
+        try:
+            with urllib.request.urlopen(url.format(code=code)) as response:
+                data = response.read()
+        except OSError as error:
+            print(f'{code}: {error}', file=sys.stderr)
+            failed.append(code)
+            continue
+        # a file appears at once, so readers never see it half written
+        with open(path + '.tmp', 'wb') as outfile:
+            outfile.write(data)
+        os.replace(path + '.tmp', path)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local store of MTase structures for the visualisation page.')
+    parser.add_argument('--directory', default=STRUCTURES_DIR, help='default is %(default)s')
+    parser.add_argument('--table', default=TABLE_PATH, metavar='class_withStructure.tsv',
+                        help="table with 'Repr. PDB code' column, default is %(default)s")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('status', help='list codes of the table missing in the store')
+    fetch_parser = subparsers.add_parser('fetch', help='download missing structures of the table from RCSB')
+    fetch_parser.add_argument('--url', default=DOWNLOAD_URL, help='default is %(default)s')
+    args = parser.parse_args()
+    codes = table_codes(args.table)
+    if args.command == 'fetch':
+        missing = fetch_structures(codes, args.directory, args.url)
+    else:
+        index = structure_index(args.directory)
+        missing = [code for code in codes if code not in index]
+    print(f'{len(codes) - len(missing)} of {len(codes)} structures in {args.directory}')
+    if missing:
+        print('missing: ' + ' '.join(missing))
+
+if __name__ == '__main__':
+    main()